@@ -14,6 +14,10 @@ from merceedge.api_server.resources.wire import (
     WireList,
     Wire
 )
+from merceedge.api_server.resources.metrics import (
+    Metrics,
+    WireStats
+)
 from merceedge.api_server.extensions import db
 
 
@@ -30,6 +34,10 @@ REST API:
 连线
 /wire
 /wire/{wire_id}
+/wire/{wire_id}/stats
+----------
+指标 (config: metrics: enabled: true)
+/metrics
 """
 
 
@@ -61,6 +69,8 @@ def app_run(edge):
     api.add_resource(Component, '/component/<component_id>')
     api.add_resource(WireList, '/wire')
     api.add_resource(Wire, '/wire/<wire_id>')
+    api.add_resource(WireStats, '/wire/<wire_id>/stats')
+    api.add_resource(Metrics, '/metrics')
 
     with app.app_context():
         edge.restore_entities_from_db()
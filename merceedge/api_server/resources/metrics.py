@@ -0,0 +1,27 @@
+from flask import (
+    current_app,
+    abort
+)
+from flask_restful import Resource
+
+
+class Metrics(Resource):
+    def get(self):
+        """ Bus, wireload and provider counters and latency histograms,
+            plus the listener count per event type.
+        """
+        edge = current_app.edge
+        metrics = edge.metrics.as_dict()
+        metrics['bus_listeners'] = edge.bus.listeners
+        return metrics
+
+
+class WireStats(Resource):
+    def get(self, wire_id):
+        """ Wire buffer, delivered payloads and wireload queues stats
+        """
+        wire = current_app.edge.wires.get(wire_id, None)
+        if wire:
+            return wire.stats()
+        else:
+            abort(404)
@@ -8,6 +8,7 @@ import asyncio
 import attr
 import uuid
 import functools
+import fnmatch
 import datetime
 import multiprocessing
 from time import monotonic
@@ -30,6 +31,9 @@ import merceedge.util.dt as dt_util
 import merceedge.util.id as id_util
 import merceedge.util.yaml as yaml_util
 import merceedge.util.module as module_util
+import merceedge.util.graph as graph_util
+import merceedge.util.metrics as metrics_util
+import merceedge.util.trace as trace_util
 from merceedge.util.async_util import (
     Context,
     callback,
@@ -41,9 +45,17 @@ from merceedge.util.async_util import (
     T
 )
 from merceedge.util.signal import async_register_signal_handling
+from merceedge.util.process_worker import ProcessWorker
+from merceedge.util.backpressure import (
+    WireQueue,
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_BUFFER_POLICY
+)
 from merceedge.exceptions import (
     MerceEdgeError,
-    ComponentTemplateNotFound
+    ComponentTemplateNotFound,
+    ProcessWorkerError,
+    InvalidBufferPolicy
 ) 
 from merceedge.const import (
     MATCH_ALL,
@@ -74,24 +86,56 @@ DOMAIN = "merceedge"
 
 _LOGGER = logger_code
 
+# Max number of event types with cached listener resolution
+RESOLVED_LISTENERS_CACHE_SIZE = 4096
+
+CONF_EXECUTION = 'execution'
+# WireLoad.process execution modes
+EXECUTION_LOOP = 'loop'
+EXECUTION_PROCESS = 'process'
+# Number of consumer tasks of a wireload input queue, 1 keeps payload order
+CONF_CONCURRENCY = 'concurrency'
+DEFAULT_WIRELOAD_CONCURRENCY = 1
+# Micro-batching of a wireload input queue, see WireLoad.process_batch
+CONF_MAX_BATCH = 'max_batch'
+CONF_MAX_WAIT_MS = 'max_wait_ms'
+DEFAULT_MAX_BATCH = 1
+DEFAULT_MAX_WAIT_MS = 10
+
+CONF_SHARD = 'shard'
+CONF_SHARD_WORKERS = 'workers'
+# How long we wait for a shard thread to exit
+SHARD_STOP_TIMEOUT = 10  # seconds
+
+CONF_METRICS = 'metrics'
+CONF_METRICS_ENABLED = 'enabled'
+CONF_TRACE = 'trace'
+# Trace one message in N, 0 disables tracing
+CONF_TRACE_SAMPLE_EVERY = 'sample_every'
+
 
 class MerceEdge(object):
     """Root object of Merce Edge node"""
-    def __init__(self, user_config):
+    def __init__(self, user_config, loop=None, wireload_factory=None):
         self.user_config = user_config
 
-        self.loop = asyncio.get_event_loop()
+        self.loop = loop or asyncio.get_event_loop()
         executor_opts = {'max_workers': None}  # type: Dict[str, Any]
         if sys.version_info[:2] >= (3, 6):
             executor_opts['thread_name_prefix'] = 'SyncWorker'
         self.executor = ThreadPoolExecutor(**executor_opts)
         self.loop.set_default_executor(self.executor)
 
-        self._pending_tasks = []  # type: list
+        self._pending_tasks = set()  # type: Set[asyncio.Future]
         self._track_task = True
         self.exit_code = 0
         # _async_stop will set this instead of stopping the loop
         # self._stopped = asyncio.Event()
+        self.metrics = metrics_util.Metrics(
+            (user_config.get(CONF_METRICS) or {}).get(CONF_METRICS_ENABLED, False))
+        self.tracer = trace_util.Tracer(
+            self.metrics,
+            (user_config.get(CONF_TRACE) or {}).get(CONF_TRACE_SAMPLE_EVERY, 0))
 
 
         self.bus = EventBus(self)
@@ -100,7 +144,13 @@ class MerceEdge(object):
         self.component_templates = {} # key: component template name
         self.components = {}  # key: component id
         self.wires = {} # key: wire id
-        self.wireload_factory = WireLoadFactory(user_config)
+        self._routes = {}  # type: Dict[Output, tuple]  # key: output sink
+        self.wireload_factory = wireload_factory or WireLoadFactory(user_config)
+
+        # Events routed from wires of other shards
+        self._remote_ingress = deque()  # type: deque
+        self._remote_wakeup_pending = False
+        self.shards = []  # type: List[EdgeShard]
 
         
     def dyload_component(self, component_config):
@@ -206,24 +256,97 @@ class MerceEdge(object):
                                 output_component_id, output_name, 
                                 input_component_id, input_name, 
                                 output_params={}, input_params={},
-                                wire_id=None):
+                                wire_id=None, buffer=None):
         """ connenct wire
+
+        buffer: optional wire buffer declaration, dict of size and policy
         """
         output_sink = self.components[output_component_id].outputs[output_name]
         input_slot = self.components[input_component_id].inputs[input_name]
-        wire = Wire(edge=self, output_sink=output_sink, input_slot=input_slot, id=wire_id)
+        # The wire is routed on the node that owns its output sink
+        wire = Wire(edge=output_sink.edge, output_sink=output_sink, input_slot=input_slot, id=wire_id)
         wire.set_input_params(output_params)
         wire.set_output_params(input_params)
+        if buffer:
+            wire.set_buffer(buffer.get('size', DEFAULT_BUFFER_SIZE),
+                            buffer.get('policy', DEFAULT_BUFFER_POLICY))
         # print(wire.output_sink.name, wire.output_sink, output_params, wire.output_sink.attrs)
         # print(wire.input_slot.name, wire.input_slot, input_params, wire.input_slot.attrs)
 
         self.wires[wire.id] = wire
         
-        await self.components[output_component_id].outputs[output_name].conn_output_sink(output_wire_params=output_params)
-        await self.components[input_component_id].inputs[input_name].conn_input_slot(input_wire_params=input_params)
+        await self._async_run_on(output_sink.edge, output_sink.conn_output_sink(output_wire_params=output_params))
+        await self._async_run_on(input_slot.edge, input_slot.conn_input_slot(input_wire_params=input_params))
         wire.connect()
         return wire
 
+    async def _async_run_on(self, edge, coro):
+        """Run coroutine on the event loop of edge(self or a shard)."""
+        if edge is self:
+            return await coro
+        return await asyncio.wrap_future(
+            run_coroutine_threadsafe(coro, edge.loop), loop=self.loop)
+
+    def add_wire_route(self, wire):
+        """Compile wire into the output sink -> input slots routing table.
+        """
+        output_sink = wire.output_sink
+        self._routes[output_sink] = self._routes.get(output_sink, ()) + (wire.input_slot, )
+
+    def remove_wire_route(self, wire):
+        """Remove wire from the routing table.
+        """
+        input_slots = list(self._routes.get(wire.output_sink, ()))
+        try:
+            input_slots.remove(wire.input_slot)
+        except ValueError:
+            return
+        if input_slots:
+            self._routes[wire.output_sink] = tuple(input_slots)
+        else:
+            del self._routes[wire.output_sink]
+
+    @callback
+    def async_route_output(self, output_sink, event):
+        """Deliver output sink event to every wired input slot.
+
+        This method must be run in the event loop.
+        """
+        context = event._context
+        trace = context.trace if context is not None else None
+        for input_slot in self._routes.get(output_sink, ()):
+            input_trace = None
+            if trace is not None:
+                input_trace = trace.fork(output_sink.find_wire_id(input_slot))
+            if input_slot.edge is self:
+                self.async_create_task(input_slot.emit_data_to_input(event, input_trace))
+            else:
+                # Wire spans shards
+                input_slot.edge.route_remote_input(input_slot, event, input_trace)
+
+    def route_remote_input(self, input_slot, event, trace=None):
+        """Deliver event routed by another shard to a local input slot.
+
+        Events are queued on the cross-shard channel, only the first event of
+        a batch wakes up the event loop.
+        """
+        self._remote_ingress.append((input_slot, event, trace))
+        if not self._remote_wakeup_pending:
+            self._remote_wakeup_pending = True
+            self.loop.call_soon_threadsafe(self._async_drain_remote_ingress)
+
+    @callback
+    def _async_drain_remote_ingress(self):
+        """Emit the events queued by route_remote_input.
+
+        This method must be run in the event loop.
+        """
+        self._remote_wakeup_pending = False
+        ingress = self._remote_ingress
+        for _ in range(len(ingress)):
+            input_slot, event, trace = ingress.popleft()
+            self.async_create_task(input_slot.emit_data_to_input(event, trace))
+
     def delete_wire(self, wire_id):
         """Disconnect wire
         """
@@ -236,11 +359,9 @@ class MerceEdge(object):
             return None
     
     def stop_wireload_exec(self):
-        # for wireid, wire in self.wires.items():
-        #     if wire.wire_load:
-        #         wire.wire_load.is_stop = True
-        # TODO
-        pass
+        for component in list(self.components.values()):
+            if isinstance(component, WireLoad):
+                component.stop()
                 
     def restore_entities_from_db(self):
         """Restore components / wires from local db when edge start.
@@ -270,17 +391,36 @@ class MerceEdge(object):
                 # TODO logger warn
                 continue
 
+    def _place_formula_components(self, components, wires):
+        """Place formula components on shards by connected component of the
+        wire graph.
+
+        Returns dict, key: component id, value: MerceEdge or EdgeShard
+        """
+        if not self.shards:
+            return {}
+        component_ids = [component['id'] for component in components]
+        wire_pairs = [(wire['output_sink']['component_id'],
+                       wire['input_slot']['component_id']) for wire in wires]
+        placement = graph_util.partition_nodes(component_ids, wire_pairs, len(self.shards))
+        return {component_id: self.shards[index]
+                for component_id, index in placement.items()}
+
     async def load_formula(self, formula_path):
         formula_yaml = yaml_util.load_yaml(formula_path)
         
         try:
             components = formula_yaml['components']
             wires = formula_yaml['wires']
+            self.async_start_shards()
+            placement = self._place_formula_components(components, wires)
             for component in components:
                 # TODO init component parameters
-                self.generate_component_instance(component['template'], 
-                                                 component['id'], 
-                                                 component.get('parameters', None))
+                node = placement.get(component['id'], self)
+                new_com = node.generate_component_instance(component['template'], 
+                                                           component['id'], 
+                                                           component.get('parameters', None))
+                self.components[new_com.id] = new_com
 
             for wire in wires:
                 # struct components
@@ -296,11 +436,15 @@ class MerceEdge(object):
                 
                 await self.connect_interface(output_com.id, output_name,
                                         input_com.id, input_name,
-                                        output_params, input_params)
+                                        output_params, input_params,
+                                        buffer=wire.get('buffer'))
                 
         except KeyError as e:
             _LOGGER.error("Load formula error, program exit!: {}".format(e))
             sys.exit(-1)
+        except InvalidBufferPolicy as e:
+            _LOGGER.error("Load formula error, program exit!: {}".format(e))
+            sys.exit(-1)
         except ComponentTemplateNotFound:
             _LOGGER.error(ComponentTemplateNotFound.__str__)
     
@@ -347,10 +491,35 @@ class MerceEdge(object):
         # If a task is scheduled
         if self._track_task and task is not None:
             # print("5!!!")
-            self._pending_tasks.append(task)
+            self._async_track_pending_task(task)
 
         return task
     
+    @callback
+    def async_add_edge_job(self, job: 'Job',
+                           *args: Any) -> Optional[asyncio.Future]:
+        """Add a pre-classified job from within the event loop.
+
+        This method must be run in the event loop.
+
+        job: Job to schedule.
+        args: parameters for method to call.
+        """
+        if job.job_type is JobType.Callback:
+            self.loop.call_soon(job.target, *args)
+            return None
+
+        if job.job_type is JobType.Coroutinefunction:
+            task = self.loop.create_task(job.target(*args))
+        else:
+            task = self.loop.run_in_executor(  # type: ignore
+                None, job.target, *args)
+
+        if self._track_task:
+            self._async_track_pending_task(task)
+
+        return task
+
     @callback
     def async_run_job(self, target: Callable[..., None], *args: Any) -> None:
         """Run a job from within the event loop.
@@ -376,7 +545,7 @@ class MerceEdge(object):
         task = self.loop.create_task(target)  # type: asyncio.tasks.Task
 
         if self._track_task:
-            self._pending_tasks.append(task)
+            self._async_track_pending_task(task)
 
         return task
 
@@ -391,10 +560,21 @@ class MerceEdge(object):
 
         # If a task is scheduled
         if self._track_task:
-            self._pending_tasks.append(task)
+            self._async_track_pending_task(task)
 
         return task
 
+    @callback
+    def _async_track_pending_task(self, task: asyncio.Future) -> None:
+        """Track task until it is done."""
+        self._pending_tasks.add(task)
+        task.add_done_callback(self._pending_tasks.discard)
+
+    @property
+    def pending_task_count(self) -> int:
+        """Number of tracked tasks that are still in flight."""
+        return len(self._pending_tasks)
+
     @callback
     def async_track_tasks(self) -> None:
         """Track tasks so you can wait for all tasks to be done."""
@@ -417,9 +597,9 @@ class MerceEdge(object):
         
         while self._pending_tasks:
             _LOGGER.debug("async_block_till_done -----")
+            # Finished tasks drop out through their done callback
             pending = [task for task in self._pending_tasks
                        if not task.done()]
-            self._pending_tasks.clear()
             _LOGGER.debug(pending)
             if pending:
                 _LOGGER.debug('pending')
@@ -484,6 +664,30 @@ class MerceEdge(object):
         # self.state = CoreState.running
         _async_create_timer(self)
 
+    @callback
+    def async_start_shards(self) -> None:
+        """Start the shard worker loops when sharding is configured.
+
+        This method must be run in the event loop.
+        """
+        if self.shards:
+            return
+        workers = self.user_config.get(CONF_SHARD, {}).get(CONF_SHARD_WORKERS, 0)
+        for index in range(workers):
+            shard = EdgeShard(self, index)
+            shard.start_thread()
+            self.shards.append(shard)
+        if self.shards:
+            _LOGGER.info("Started {} edge shards".format(len(self.shards)))
+
+    async def async_stop_shards(self) -> None:
+        """Stop the shard worker loops and wait for their threads."""
+        for shard in self.shards:
+            shard.stop()
+        for shard in self.shards:
+            await self.async_add_executor_job(shard.join_thread, SHARD_STOP_TIMEOUT)
+        self.shards = []
+
     async def async_stop(self, exit_code: int = 0, *,
                          force: bool = False) -> None:
         """Stop MerceEdge and shuts down all threads.
@@ -500,6 +704,7 @@ class MerceEdge(object):
         self.async_track_tasks()
         self.bus.async_fire(EVENT_EDGE_STOP)
         await self.async_block_till_done()
+        await self.async_stop_shards()
  
         self.executor.shutdown()
         
@@ -510,6 +715,40 @@ class MerceEdge(object):
         self.add_job(emit_call)
 
 
+class EdgeShard(MerceEdge):
+    """Worker node running a partition of the wire graph on its own event
+    loop thread, with its own EventBus. Opt-in with the ``shard.workers``
+    user config.
+    """
+    def __init__(self, edge, index):
+        super(EdgeShard, self).__init__(edge.user_config,
+                                        loop=asyncio.new_event_loop(),
+                                        wireload_factory=edge.wireload_factory)
+        self.index = index
+        self.component_templates = edge.component_templates
+        self.metrics = edge.metrics
+        self.tracer = edge.tracer
+        self._thread = None
+
+    def start_thread(self):
+        """Run the shard event loop in a new thread."""
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_forever()
+            self.loop.close()
+
+        fire_coroutine_threadsafe(self.async_start(), self.loop)
+        self._thread = threading.Thread(target=run_loop,
+                                        name="EdgeShard-{}".format(self.index),
+                                        daemon=True)
+        self._thread.start()
+
+    def join_thread(self, timeout=None):
+        """Wait for the shard event loop thread to exit."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
 class Entity(object):
     """ABC for Merce Edge entity(Component, Interface, etc.)"""
     id = id_util.generte_unique_id()
@@ -600,6 +839,7 @@ class Interface(Entity):
         self.component = component
         self.propreties = propreties or {}
         self.attrs = attrs or {}
+        self.id = id_util.generte_unique_id()
         self._set_protocol()
     
     def _set_protocol(self):
@@ -636,7 +876,7 @@ class Output(Interface):
     
     def _init_provider(self):
         try:
-            self.provider = ServiceProviderFactory.get_provider(self.protocol)
+            self.provider = ServiceProviderFactory.get_provider(self.protocol, self.edge)
             _LOGGER.debug("Output {} load provider {}".format(self.name, self.provider))
             # if self.provider:
             #     self.provider.new_instance_setup(self.name, self.attrs, True)
@@ -653,11 +893,20 @@ class Output(Interface):
                                        output_wire_params=output_wire_params,
                                        callback=self.output_sink_callback)
     
+    def find_wire_id(self, input_slot):
+        """Return id of the wire from this output sink to input slot."""
+        for wire in self.output_wires.values():
+            if wire.input_slot is input_slot:
+                return wire.id
+        return None
+
+    @callback
     def output_sink_callback(self, event):
-        """Send output Event"""
-        # 发送wirefire Event（连线的时候Wire的Output需要注册Input的wirefire事件）
-        wirefire_event_type = "wirefire_{}_{}".format(self.component.id, self.name)
-        self.edge.bus.fire(wirefire_event_type, event.data)
+        """Send output Event to the wired input slots"""
+        context = event._context
+        if context is not None and context.trace is not None:
+            context.trace.stamp(trace_util.HOP_OUTPUT_SINK)
+        self.edge.async_route_output(self, event)
 
 
 class Input(Interface):
@@ -680,11 +929,13 @@ class Input(Interface):
     def del_wire(self, wire_id):
         """Remove wire
         """
+        if self.provider is not None:
+            self.provider.disconn_input_slot(self)
         del self.input_wires[wire_id]
         
     def _init_provider(self):
         try:
-            self.provider = ServiceProviderFactory.get_provider(self.protocol)
+            self.provider = ServiceProviderFactory.get_provider(self.protocol, self.edge)
             # self.edge.add_job(self.provider.async_setup, self.edge, self.attrs)
         except KeyError:
             # TODO log no such provider key error
@@ -694,9 +945,26 @@ class Input(Interface):
         self.edge.add_job(self.provider.async_setup, self.edge, self.attrs)
         await self.provider.conn_input_slot(self, input_wire_params)
 
-    async def emit_data_to_input(self, event):
+    async def emit_data_to_input(self, event, trace=None):
         # Emit data to EventBus and invoke configuration service send data function.
-        await self.provider.emit_input_slot(self, event.data)
+        payload = event.data
+        if trace is not None:
+            trace.stamp(trace_util.HOP_INPUT_EMIT)
+            if self.provider.queues_payload_objects and isinstance(self.component, WireLoad):
+                # The trace goes on through the wireload input queue
+                payload = trace_util.TracedPayload(payload, trace)
+                trace = None
+        metrics = self.edge.metrics
+        if metrics.enabled:
+            metrics.counter('input_payloads', self.id).inc()
+            await metrics_util.timed_await(
+                metrics.histogram('provider_emit_seconds', self.id),
+                self.provider.emit_input_slot, self, payload)
+        else:
+            await self.provider.emit_input_slot(self, payload)
+        if trace is not None:
+            trace.stamp(trace_util.HOP_PROVIDER_PUBLISH)
+            self.edge.tracer.finish(trace)
 
 
 class State(object):
@@ -715,15 +983,16 @@ class Wire(Entity):
         self.output = input_slot
         self.input_params = dict()
         self.output_params = dict()
+        self.buffer_size = DEFAULT_BUFFER_SIZE
+        self.buffer_policy = DEFAULT_BUFFER_POLICY
 
         self.input.add_wire(self)
         self.output.add_wire(self)
     
     def connect(self):
-        outcom_id = self.output_sink.component.id
-        out_name = self.output_sink.name
-        wirefire_event_type = "wirefire_{}_{}".format(outcom_id, out_name)
-        self.edge.bus.async_listen(wirefire_event_type, self.input_slot.emit_data_to_input)
+        self.edge.add_wire_route(self)
+        if isinstance(self.input_slot.component, WireLoad):
+            self.input_slot.component.start_workers()
           
     def _add_input(self, output_sink: Output):
         output_sink.add_wire(self)
@@ -755,7 +1024,50 @@ class Wire(Entity):
         self.output_params = parameters
         self.output.set_attrs(parameters)
 
+    def set_buffer(self, size, policy):
+        """Set backpressure buffer of the wire, applied to the input queue
+        of the downstream wireload.
+
+        The output queue of the upstream wireload carries the payloads of
+        all its outputs, it is left unbounded.
+        """
+        self.buffer_size = size
+        self.buffer_policy = policy
+        wireload = self.input_slot.component
+        if isinstance(wireload, WireLoad) and not wireload.set_input_buffer(size, policy):
+            # Another wire declared the shared wireload queue buffer
+            self.buffer_size = wireload.input_q.maxsize
+            self.buffer_policy = wireload.input_q.policy
+
+    def stats(self):
+        """Return wire buffer, delivered payloads and wireload queues stats."""
+        metrics = self.edge.metrics
+        info = {
+            'id': self.id,
+            'output': {'component_id': self.output_sink.component.id,
+                       'name': self.output_sink.name},
+            'input': {'component_id': self.input_slot.component.id,
+                      'name': self.input_slot.name},
+            'buffer': {'size': self.buffer_size, 'policy': self.buffer_policy},
+            'input_payloads': metrics.get_counter('input_payloads', self.input_slot.id),
+            'provider_emit_seconds': metrics.get_histogram(
+                'provider_emit_seconds', self.input_slot.id)
+        }
+        for end, component in (('input_wireload', self.input_slot.component),
+                               ('output_wireload', self.output_sink.component)):
+            if isinstance(component, WireLoad):
+                info[end] = component.queue_stats()
+                info[end]['process_seconds'] = metrics.get_histogram(
+                    'wireload_process_seconds', component.id)
+        provider = self.output_sink.provider
+        output_sink_stats = provider.output_stats(self.output_sink) if provider else None
+        if output_sink_stats is not None:
+            info['output_sink'] = output_sink_stats
+        info['trace'] = self.edge.tracer.wire_stats(self.id)
+        return info
+
     def disconnect(self):
+        self.edge.remove_wire_route(self)
         self.input.del_wire(self.id)
         self.output.del_wire(self.id)
 
@@ -791,43 +1103,208 @@ class WireLoad(Component):
 
     def __init__(self, edge, model_template_config, component_id=None, init_params=None):
         super(WireLoad, self).__init__(edge, model_template_config, id=component_id, init_params=init_params)
-        self.input_q = asyncio.Queue(maxsize=3, loop=self.edge.loop)
-        self.output_q = asyncio.Queue(maxsize=3, loop=self.edge.loop)
+        self.input_q = WireQueue()
+        self.output_q = WireQueue()
+        # (size, policy) of the input queue declared by a wire
+        self._input_buffer = None
         self.is_stop = False
         self.emit_output_call = self.emit_output_payload
+        # Run process() on the event loop or in a dedicated worker process
+        self.execution = self._get_run_option(CONF_EXECUTION, EXECUTION_LOOP)
+        self._process_worker = None
+        self.concurrency = int(self._get_run_option(CONF_CONCURRENCY,
+                                                    DEFAULT_WIRELOAD_CONCURRENCY))
+        self._workers = []
+        self.max_batch = int(self._get_run_option(CONF_MAX_BATCH, DEFAULT_MAX_BATCH))
+        self.max_wait_ms = float(self._get_run_option(CONF_MAX_WAIT_MS, DEFAULT_MAX_WAIT_MS))
+
+    def _get_run_option(self, key, default):
+        """Formula parameters override the component template."""
+        return self.parameters.get(
+            key, self.model_template_config['component'].get(key, default))
 
     def before_run_setup(self):
         """Need implemented"""
         raise NotImplementedError
 
+    def set_input_buffer(self, size, policy):
+        """Configure the input queue in place, the running workers keep
+        consuming it.
+
+        All the wires into the wireload share the input queue, the first
+        declared buffer is kept. Returns False if a wire declared another one.
+        """
+        declared = self._input_buffer
+        if declared is not None and declared != (size, policy):
+            _LOGGER.warning(
+                "Wireload {} input buffer {} ignored, wires share the declared buffer {}".format(
+                    self.id, (size, policy), declared))
+            return False
+        self.input_q.configure(size, policy)
+        self._input_buffer = (size, policy)
+        return True
+
+    def queue_stats(self):
+        """Return input and output queue depth, size, policy and drop counts."""
+        return {
+            'input': self.input_q.stats(),
+            'output': self.output_q.stats()
+        }
+
     async def put_input_payload(self, payload):
         await self.input_q.put(payload)
-        self.edge.add_job(self.run)
+        metrics = self.edge.metrics
+        if metrics.enabled:
+            metrics.counter('wireload_input_payloads', self.id).inc()
         
     async def put_output_payload(self, output_name, payload):
         await self.output_q.put((output_name, payload))
+        metrics = self.edge.metrics
+        if metrics.enabled:
+            metrics.counter('wireload_output_payloads', self.id).inc()
         self.edge.wireload_emit_output_payload(output_name, self.emit_output_call, payload)
 
     def process(self, input_payload):
         """Need implemented"""
         raise NotImplementedError
 
+    async def process_batch(self, input_payloads):
+        """Process a list of input payloads at once.
+
+        Called when max_batch > 1 with up to max_batch payloads gathered
+        within max_wait_ms. Override it for vectorized processing, the
+        default processes payloads one by one.
+        """
+        for input_payload in input_payloads:
+            await self.process(input_payload)
+
+    def start_workers(self):
+        """Start the consumer tasks of the input queue, once for all wires.
+
+        The tasks are not tracked by the edge, they live until stop().
+        """
+        if self._workers or self.is_stop:
+            return
+        for _ in range(self.concurrency):
+            self._workers.append(
+                run_coroutine_threadsafe(self.run(), self.edge.loop))
+
     async def run(self):
         while True:
             if self.is_stop:
                 _LOGGER.debug("stop wireload------------")
                 break
-            input_payload = await self.input_q.get()
+            if self.max_batch > 1:
+                input_payloads = await self._get_input_batch()
+            else:
+                input_payloads = [await self.input_q.get()]
+            traces = trace_util.untrace_payloads(input_payloads)
+            for trace in traces:
+                trace.stamp(trace_util.HOP_WIRELOAD_DEQUEUE)
             
-            await self.process(input_payload)
-            del input_payload
+            metrics = self.edge.metrics
+            start = monotonic()
+            try:
+                if self.execution == EXECUTION_PROCESS:
+                    await self._process_in_worker(input_payloads)
+                else:
+                    await self._process_payloads(self, input_payloads)
+                if metrics.enabled:
+                    metrics.histogram('wireload_process_seconds', self.id).observe(
+                        monotonic() - start)
+                for trace in traces:
+                    trace.stamp(trace_util.HOP_PROCESS_DONE)
+                    self.edge.tracer.finish(trace)
+            except Exception:  # pylint: disable=broad-except
+                # Keep the worker alive for the next payloads
+                _LOGGER.exception("Wireload {} process error".format(self.id))
+            del input_payloads
             
             # if result:
             #     await self.output_q.put(result)
             #     self.edge.add_job(self.emit_output_payload)
 
+    async def _get_input_batch(self):
+        """Wait for a payload, then gather up to max_batch payloads until
+        max_wait_ms elapsed.
+        """
+        input_payloads = [await self.input_q.get()]
+        deadline = self.edge.loop.time() + self.max_wait_ms / 1000
+        while len(input_payloads) < self.max_batch:
+            if not self.input_q.empty():
+                input_payloads.append(self.input_q.get_nowait())
+                continue
+            timeout = deadline - self.edge.loop.time()
+            if timeout <= 0:
+                break
+            try:
+                input_payloads.append(
+                    await asyncio.wait_for(self.input_q.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return input_payloads
+
+    @staticmethod
+    async def _process_payloads(wireload, input_payloads):
+        if len(input_payloads) == 1:
+            await wireload.process(input_payloads[0])
+        else:
+            await wireload.process_batch(input_payloads)
+
+    def stop(self):
+        """Stop wireload execution"""
+        self.is_stop = True
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        if self._process_worker is not None:
+            self._process_worker.stop()
+            self._process_worker = None
+
+    async def _process_in_worker(self, input_payloads):
+        """Run process() in the worker process, put its outputs here."""
+        if self._process_worker is None:
+            self._process_worker = ProcessWorker(self._process_worker_setup,
+                                                 name="WireLoad-{}".format(self.id))
+        try:
+            outputs = await self.edge.async_add_executor_job(
+                self._process_worker.call, input_payloads)
+        except ProcessWorkerError as e:
+            _LOGGER.error(str(e))
+            return
+        for output_name, payload in outputs:
+            await self.put_output_payload(output_name, payload)
+
+    def _process_worker_setup(self):
+        """Build the handler running in the worker process: a copy of this
+        wireload on a worker edge, collecting the outputs of process().
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        init_params = dict(self.parameters)
+        init_params[CONF_EXECUTION] = EXECUTION_LOOP
+        wireload = self.__class__(_WireLoadWorkerEdge(self.edge.user_config, loop),
+                                  self.model_template_config,
+                                  self.id,
+                                  init_params)
+        outputs = []
+
+        async def collect_output_payload(output_name, payload):
+            outputs.append((output_name, payload))
+        wireload.put_output_payload = collect_output_payload
+
+        def handle(input_payloads):
+            del outputs[:]
+            loop.run_until_complete(self._process_payloads(wireload, input_payloads))
+            return list(outputs)
+        return handle
+
     async def emit_output_payload(self):
-        output_payload = await self.output_q.get()
+        try:
+            output_payload = self.output_q.get_nowait()
+        except asyncio.QueueEmpty:
+            # Dropped by the output buffer policy
+            return
         try:
             if output_payload:
                 
@@ -838,21 +1315,97 @@ class WireLoad(Component):
             _LOGGER.warn("Cannot find output: {}".format(e))
 
     
+class _WireLoadWorkerEdge(object):
+    """Stand-in edge of a wireload copy living in a worker process. Jobs run
+    on the worker loop and its default executor, created in the worker.
+    """
+    def __init__(self, user_config, loop):
+        self.user_config = user_config
+        self.loop = loop
+        self.metrics = metrics_util.Metrics()
+        self.tracer = trace_util.Tracer(self.metrics)
+        self.bus = EventBus(self)
+        self._track_task = False
+
+    add_job = MerceEdge.add_job
+    async_add_job = MerceEdge.async_add_job
+    async_create_task = MerceEdge.async_create_task
+    async_add_executor_job = MerceEdge.async_add_executor_job
+
+
+class JobType(enum.Enum):
+    """Represent how a job target is scheduled."""
+
+    Coroutinefunction = 1
+    Callback = 2
+    Executor = 3
+
+
+def _get_job_type(target: Callable[..., Any]) -> JobType:
+    """Determine the job type of a callable."""
+    # Check for partials to properly determine if coroutine function
+    check_target = target
+    while isinstance(check_target, functools.partial):
+        check_target = check_target.func
+    if is_callback(check_target):
+        return JobType.Callback
+    if asyncio.iscoroutinefunction(check_target):
+        return JobType.Coroutinefunction
+    return JobType.Executor
+
+
+class Job(object):
+    # pylint: disable=too-few-public-methods
+    """Represents a job target classified once, eg. an EventBus listener."""
+
+    __slots__ = ['target', 'job_type']
+
+    def __init__(self, target: Callable[..., Any]) -> None:
+        """Create a job."""
+        self.target = target
+        self.job_type = _get_job_type(target)
+
+    def __repr__(self) -> str:
+        """Return the representation."""
+        return "<Job {} {}>".format(self.job_type, self.target)
+
+
 class Event(object):
     # pylint: disable=too-few-public-methods
-    """Represents an event within the Bus."""
+    """Represents an event within the Bus.
+
+    The fired time is kept as a monotonic clock value and the context is
+    only created when they are read.
+    """
 
-    __slots__ = ['event_type', 'data', 'time_fired', 'context']
+    __slots__ = ['event_type', 'data', '_time_fired', '_time_fired_monotonic',
+                 '_context']
 
     def __init__(self, event_type: str, data: Optional[Dict] = None,
-                 time_fired: Optional[int] = None,
+                 time_fired: Optional[datetime.datetime] = None,
                  context: Optional[Context] = None) -> None:
         """Initialize a new event."""
         self.event_type = event_type
         # TODO 
         self.data = data
-        self.time_fired = time_fired or dt_util.utcnow()
-        self.context = context or Context()
+        self._time_fired = time_fired
+        self._time_fired_monotonic = monotonic() if time_fired is None else None
+        self._context = context
+
+    @property
+    def time_fired(self) -> datetime.datetime:
+        """Return the UTC time the event was fired."""
+        if self._time_fired is None:
+            self._time_fired = dt_util.utcnow() - datetime.timedelta(
+                seconds=monotonic() - self._time_fired_monotonic)
+        return self._time_fired
+
+    @property
+    def context(self) -> Context:
+        """Return the context that triggered the event."""
+        if self._context is None:
+            self._context = Context()
+        return self._context
 
     def as_dict(self) -> Dict:
         """Create a dict representation of this Event."""
@@ -891,14 +1444,31 @@ class EventBus(object):
 
     def __init__(self, edge: MerceEdge) -> None:
         """Initialize a new event bus."""
-        self._listeners = {} # type: Dict[str, List[Callable]]
+        # Listener jobs are kept in insertion ordered dicts used as sets, so
+        # a listener is removed in constant time.
+        self._listeners = {} # type: Dict[str, Dict[Job, None]]
+        # Patterns ending with a single "*", keyed by prefix. MATCH_ALL is
+        # the empty prefix.
+        self._prefix_listeners = {} # type: Dict[str, Dict[Job, None]]
+        # Any other wildcard pattern, matched with fnmatch
+        self._glob_listeners = {} # type: Dict[str, Dict[Job, None]]
+        # Listeners resolved per fired event type
+        self._resolved_listeners = {} # type: Dict[str, tuple]
         self.edge = edge
+        # Events fired from other threads, drained on the loop in batches
+        self._ingress = deque()  # type: deque
+        self._ingress_wakeup_pending = False
     
     @callback
     def async_listeners(self) -> Dict[str, int]:
         """Dict with events and the number of listeners."""
-        return {key: len(self._listeners[key])
-                for key in self._listeners}
+        listeners = {key: len(self._listeners[key])
+                     for key in self._listeners}
+        listeners.update({prefix + MATCH_ALL: len(jobs)
+                          for prefix, jobs in self._prefix_listeners.items()})
+        listeners.update({pattern: len(jobs)
+                          for pattern, jobs in self._glob_listeners.items()})
+        return listeners
 
     @property
     def listeners(self) -> Dict[str, int]:
@@ -910,9 +1480,33 @@ class EventBus(object):
 
     def fire(self, event_type: str, event_data: Optional[Dict] = None,
              context: Optional[Context] = None) -> None:
-        """Fire an event."""
-        self.edge.loop.call_soon_threadsafe(
-            self.async_fire, event_type, event_data, context)
+        """Fire an event.
+
+        Events are queued on the ingress buffer, only the first event of a
+        batch wakes up the event loop.
+        """
+        if context is None and self.edge.tracer.sample_every:
+            context = self.edge.tracer.sample_context()
+        self._ingress.append((event_type, event_data, context))
+        if not self._ingress_wakeup_pending:
+            # Racing producers may both schedule a drain, the second one
+            # finds the buffer empty.
+            self._ingress_wakeup_pending = True
+            self.edge.loop.call_soon_threadsafe(self._async_drain_ingress)
+
+    @callback
+    def _async_drain_ingress(self) -> None:
+        """Fire the events queued by fire.
+
+        This method must be run in the event loop.
+        """
+        # Reset before draining, events appended after the batch snapshot
+        # schedule a new drain.
+        self._ingress_wakeup_pending = False
+        ingress = self._ingress
+        for _ in range(len(ingress)):
+            # Sampled by fire already
+            self._async_fire(*ingress.popleft(), sample=False)
     
     @callback
     def async_fire(self, event_type: str, event_data: Optional[Dict] = None,
@@ -920,32 +1514,110 @@ class EventBus(object):
         """Fire an event.
         This method must be run in the event loop
         """
+        self._async_fire(event_type, event_data, context, sample=True)
+
+    @callback
+    def _async_fire(self, event_type: str, event_data: Optional[Dict],
+                    context: Optional[Context], sample: bool) -> None:
+        """Fire an event, sample its trace if sample is set.
+
+        This method must be run in the event loop.
+        """
         # _LOGGER.info("async_fire: {}".format(event_type))
 
-        listeners = self._listeners.get(event_type, [])
+        listeners = self._resolved_listeners.get(event_type)
+        if listeners is None:
+            listeners = self._async_resolve_listeners(event_type)
+
+        metrics = self.edge.metrics
+        if metrics.enabled:
+            metrics.counter('bus_events_fired', event_type).inc()
+
+        if not listeners:
+            return
 
-        # EVENT_HOMEASSISTANT_CLOSE should go only to his listeners
-        match_all_listeners = self._listeners.get(MATCH_ALL)
-        if (match_all_listeners is not None):
-            listeners = match_all_listeners + listeners
+        if context is None and sample and self.edge.tracer.sample_every:
+            context = self.edge.tracer.sample_context()
+        if context is not None and context.trace is not None:
+            context.trace.stamp(trace_util.HOP_BUS_DISPATCH)
 
         event = Event(event_type, event_data, None, context)
 
         # if event_type != EVENT_TIME_CHANGED:
         #     _LOGGER.debug("Bus:Handling %s", event)
 
-        if not listeners:
+        if metrics.enabled:
+            histogram = metrics.histogram('bus_listener_seconds', event_type)
+            for job in listeners:
+                self._async_add_timed_job(histogram, job, event)
             return
 
-        for func in listeners:
-            self.edge.async_add_job(func, event)
+        for job in listeners:
+            self.edge.async_add_edge_job(job, event)
+
+    @callback
+    def _async_add_timed_job(self, histogram, job: Job, event: Event) -> None:
+        """Schedule a listener job, observing how long it takes."""
+        if job.job_type is JobType.Callback:
+            self.edge.loop.call_soon(metrics_util.timed_call, histogram,
+                                     job.target, event)
+        elif job.job_type is JobType.Coroutinefunction:
+            self.edge.async_create_task(
+                metrics_util.timed_await(histogram, job.target, event))
+        else:
+            self.edge.async_add_executor_job(metrics_util.timed_call, histogram,
+                                             job.target, event)
     
+    @callback
+    def _async_resolve_listeners(self, event_type: str) -> tuple:
+        """Resolve and cache the listeners of an event type.
+
+        Wildcard listeners come first, then listeners of the exact type.
+
+        This method must be run in the event loop.
+        """
+        listeners = []  # type: List[Job]
+        if self._prefix_listeners:
+            for end in range(len(event_type) + 1):
+                jobs = self._prefix_listeners.get(event_type[:end])
+                if jobs:
+                    listeners.extend(jobs)
+        for pattern, jobs in self._glob_listeners.items():
+            if fnmatch.fnmatchcase(event_type, pattern):
+                listeners.extend(jobs)
+        listeners.extend(self._listeners.get(event_type, ()))
+
+        if len(self._resolved_listeners) >= RESOLVED_LISTENERS_CACHE_SIZE:
+            self._resolved_listeners.clear()
+        resolved = tuple(listeners)
+        self._resolved_listeners[event_type] = resolved
+        return resolved
+
+    def _listeners_index(self, event_type: str) -> tuple:
+        """Return the listeners dict and key an event type subscribes in."""
+        if '*' not in event_type and '?' not in event_type:
+            return self._listeners, event_type
+        prefix = event_type[:-1]
+        if event_type.endswith('*') and '*' not in prefix and '?' not in prefix:
+            return self._prefix_listeners, prefix
+        return self._glob_listeners, event_type
+
+    @callback
+    def _async_invalidate_resolved(self, listeners: Dict[str, Dict[Job, None]],
+                                   key: str) -> None:
+        """Drop cached resolutions a subscription change affects."""
+        if listeners is self._listeners:
+            self._resolved_listeners.pop(key, None)
+        else:
+            self._resolved_listeners.clear()
+
     def listen(
             self, event_type: str, listener: Callable) -> CALLBACK_TYPE:
         """Listen for all events or events of a specific type.
 
         To listen to all events specify the constant ``MATCH_ALL``
-        as event_type.
+        as event_type, to listen to a family of events use a wildcard
+        pattern, eg. ``rtmp_frame_*``.
         """
         async_remove_listener = run_callback_threadsafe(
             self.edge.loop, self.async_listen, event_type, listener).result()
@@ -962,18 +1634,29 @@ class EventBus(object):
         """Listen for all events or events of a specific type.
 
         To listen to all events specify the constant ``MATCH_ALL``
-        as event_type.
+        as event_type, to listen to a family of events use a wildcard
+        pattern, eg. ``rtmp_frame_*``.
+
+        This method must be run in the event loop.
+        """
+        return self._async_listen_job(event_type, Job(listener))
+
+    @callback
+    def _async_listen_job(self, event_type: str, job: Job) -> CALLBACK_TYPE:
+        """Listen for events of a specific type with a classified job.
 
         This method must be run in the event loop.
         """
-        if event_type in self._listeners:
-            self._listeners[event_type].append(listener)
+        listeners, key = self._listeners_index(event_type)
+        if key in listeners:
+            listeners[key][job] = None
         else:
-            self._listeners[event_type] = [listener]
+            listeners[key] = {job: None}
+        self._async_invalidate_resolved(listeners, key)
 
         def remove_listener() -> None:
             """Remove the listener."""
-            self._async_remove_listener(event_type, listener)
+            self._async_remove_listener(event_type, job)
 
         return remove_listener
 
@@ -982,7 +1665,8 @@ class EventBus(object):
         """Listen once for event of a specific type.
 
         To listen to all events specify the constant ``MATCH_ALL``
-        as event_type.
+        as event_type, to listen to a family of events use a wildcard
+        pattern, eg. ``rtmp_frame_*``.
 
         Returns function to unsubscribe the listener.
         """
@@ -1003,12 +1687,15 @@ class EventBus(object):
         """Listen once for event of a specific type.
 
         To listen to all events specify the constant ``MATCH_ALL``
-        as event_type.
+        as event_type, to listen to a family of events use a wildcard
+        pattern, eg. ``rtmp_frame_*``.
 
         Returns registered listener that can be used with remove_listener.
 
         This method must be run in the event loop.
         """
+        job = None  # type: Optional[Job]
+
         @callback
         def onetime_listener(event: Event) -> None:
             """Remove listener from event bus and then fire listener."""
@@ -1020,28 +1707,31 @@ class EventBus(object):
             # multiple times as well.
             # This will make sure the second time it does nothing.
             setattr(onetime_listener, 'run', True)
-            self._async_remove_listener(event_type, onetime_listener)
+            self._async_remove_listener(event_type, job)
             self.edge.async_run_job(listener, event)
 
-        return self.async_listen(event_type, onetime_listener)
+        job = Job(onetime_listener)
+        return self._async_listen_job(event_type, job)
 
     @callback
     def _async_remove_listener(
-            self, event_type: str, listener: Callable) -> None:
-        """Remove a listener of a specific event_type.
+            self, event_type: str, job: Job) -> None:
+        """Remove a listener job of a specific event_type.
 
         This method must be run in the event loop.
         """
+        listeners, key = self._listeners_index(event_type)
         try:
-            self._listeners[event_type].remove(listener)
-
-            # delete event_type list if empty
-            if not self._listeners[event_type]:
-                self._listeners.pop(event_type)
-        except (KeyError, ValueError):
-            # KeyError is key event_type listener did not exist
-            # ValueError if listener did not exist within event_type
-            _LOGGER.warning("Unable to remove unknown listener %s", listener)
+            del listeners[key][job]
+            self._async_invalidate_resolved(listeners, key)
+
+            # delete event_type dict if empty
+            if not listeners[key]:
+                listeners.pop(key)
+        except KeyError:
+            # KeyError is key event_type listener did not exist or
+            # listener did not exist within event_type
+            _LOGGER.warning("Unable to remove unknown listener %s", job)
 
 
 
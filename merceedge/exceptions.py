@@ -57,4 +57,41 @@ class ComponentNeedInitParamsError(MerceEdgeError):
         super().__init__(
             self, "Component  {} need init parameter {}".format(cls_name, param_key))
         self.cls_name = cls_name
-        self.param_key = param_key
\ No newline at end of file
+        self.param_key = param_key
+
+
+class ProcessWorkerError(MerceEdgeError):
+    """ Raised when the handler of a worker process failed.
+    """
+    def __init__(self, name: str, worker_traceback: str) -> None:
+        """Initialize error."""
+        super().__init__(
+            self, "Process worker {} failed:\n{}".format(name, worker_traceback))
+        self.name = name
+        self.worker_traceback = worker_traceback
+
+
+class InvalidBufferPolicy(MerceEdgeError):
+    """ Raised when a wire declares an unknown buffer policy or size.
+    """
+    def __init__(self, policy: str, size: int) -> None:
+        """Initialize error."""
+        super().__init__(
+            self, "Invalid wire buffer policy {} size {}".format(policy, size))
+        self.policy = policy
+        self.size = size
+
+
+class InvalidFrame(MerceEdgeError):
+    """ Raised when a video frame can not be encoded or decoded.
+    """
+
+
+class InvalidTopicFilter(MerceEdgeError):
+    """ Raised when an MQTT topic filter misplaces a + or # wildcard.
+    """
+    def __init__(self, topic_filter: str) -> None:
+        """Initialize error."""
+        super().__init__(
+            self, "Invalid topic filter {}".format(topic_filter))
+        self.topic_filter = topic_filter
@@ -44,10 +44,12 @@ class ServiceProviderFactory(object):
         ServiceProviderFactory.edge = edge
     
     @staticmethod 
-    def get_provider(provider_name):
+    def get_provider(provider_name, edge=None):
+        """ Create provider instance bound to edge, default the factory edge
+        """
         try:
             provider_class = ServiceProviderFactory.provider_classes[provider_name]
-            provider_obj = provider_class(ServiceProviderFactory.edge, ServiceProviderFactory.config)
+            provider_obj = provider_class(edge or ServiceProviderFactory.edge, ServiceProviderFactory.config)
             return provider_obj
         except KeyError:
             return None
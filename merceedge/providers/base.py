@@ -1,3 +1,5 @@
+from merceedge.util.async_util import run_callback_in_loop
+
 
 class Singleton(object):
     _instance = None
@@ -9,6 +11,10 @@ class Singleton(object):
 
 
 class ServiceProvider(object):
+    # emit_input_slot puts payload objects on the wireload input queue,
+    # sampled payloads go wrapped in a TracedPayload
+    queues_payload_objects = False
+
     def __init__(self, edge, config):
         """
         edge: MerceEdge instance
@@ -16,6 +22,44 @@ class ServiceProvider(object):
         """
         self.edge = edge
         self.config = config
+        # key: output, value: EventBus remove listener handle
+        self._output_listeners = {}
+        # key: event type, value: remove listener handle of the provider
+        # own listeners, eg. edge stop
+        self._listeners = {}
+
+    def _async_listen(self, event_type, callback, once=False):
+        """Listen event_type once per provider, async_setup runs on every
+        wire connect. The provider owns the remove listener handle until
+        _release_listeners().
+        """
+        if event_type not in self._listeners:
+            listen = self.edge.bus.async_listen_once if once else self.edge.bus.async_listen
+            self._listeners[event_type] = listen(event_type, callback)
+
+    def _release_listeners(self, fired_event_type=None):
+        """Remove the provider listeners, but the once listener of
+        fired_event_type which removed itself.
+        """
+        listeners, self._listeners = self._listeners, {}
+        listeners.pop(fired_event_type, None)
+        for remove_listener in listeners.values():
+            run_callback_in_loop(self.edge.loop, remove_listener)
+
+    def _async_listen_output(self, output, event_type, callback):
+        """Listen output sink event, once per output. The provider owns the
+        remove listener handle until the output is released.
+        """
+        if output not in self._output_listeners:
+            self._output_listeners[output] = self.edge.bus.async_listen(event_type, callback)
+
+    def _release_output(self, output):
+        """Remove the output sink event listener. Wires are deleted from the
+        REST API thread too, the listener is removed in the edge loop.
+        """
+        remove_listener = self._output_listeners.pop(output, None)
+        if remove_listener is not None:
+            run_callback_in_loop(self.edge.loop, remove_listener)
     
     async def async_setup(self, edge, config):
         raise NotImplementedError
@@ -33,7 +77,16 @@ class ServiceProvider(object):
         """send data to input slot"""
         raise NotImplementedError
 
-    async def disconn_output_sink(self, output):
+    def disconn_output_sink(self, output):
         """ disconnect wire output sink
         """
         raise NotImplementedError
+
+    def output_stats(self, output):
+        """Provider stats of the output sink, served with the wire stats"""
+        return None
+
+    def disconn_input_slot(self, input):
+        """ disconnect wire input slot
+        """
+        pass
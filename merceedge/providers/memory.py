@@ -0,0 +1,167 @@
+import asyncio
+import weakref
+
+from merceedge.providers.base import ServiceProvider
+from merceedge.util.backpressure import (
+    WireQueue,
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_BUFFER_POLICY
+)
+from merceedge.util.async_util import run_callback_in_loop
+from merceedge.settings import (
+    logger_access,
+    logger_code,
+    logger_console
+)
+
+_LOGGER = logger_code
+
+ATTR_CHANNEL = 'channel'
+ATTR_BUFFER_SIZE = 'buffer_size'
+ATTR_BUFFER_POLICY = 'buffer_policy'
+
+
+class MemorySubscriber(object):
+    """Bounded queue of a channel subscriber and the task pumping it into
+    the subscriber callback.
+    """
+    def __init__(self, channel, target, maxsize=DEFAULT_BUFFER_SIZE,
+                 policy=DEFAULT_BUFFER_POLICY):
+        self.channel = channel
+        self.target = target
+        self.queue = WireQueue(maxsize, policy)
+        self._pump = asyncio.ensure_future(self._async_pump())
+
+    async def _async_pump(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                result = self.target(payload)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Memory channel {} subscriber error".format(self.channel.name))
+
+    def unsubscribe(self):
+        """Stop the subscriber. Must be run in the event loop."""
+        self._pump.cancel()
+        self.channel.remove_subscriber(self)
+
+
+class MemoryChannel(object):
+    """Named in-process channel, payloads are passed by reference to every
+    subscriber queue.
+    """
+    def __init__(self, name, channels):
+        self.name = name
+        self.subscribers = {}  # type: Dict[MemorySubscriber, None]
+        # Channels of the event loop, the channel leaves it with its last
+        # subscriber
+        self._channels = channels
+
+    def remove_subscriber(self, subscriber):
+        self.subscribers.pop(subscriber, None)
+        if not self.subscribers and self._channels.get(self.name) is self:
+            del self._channels[self.name]
+
+    async def publish(self, payload):
+        """Put payload on each subscriber queue, waits while a blocking
+        subscriber queue is full.
+        """
+        for subscriber in list(self.subscribers):
+            await subscriber.queue.put(payload)
+
+
+class MemoryInterfaceProvider(ServiceProvider):
+    """Wire co-located components through in-process channels.
+
+    The channel of an interface is its ``channel`` attribute, default
+    ``<component id>_<interface name>``. In-process code talks to the
+    channels with publish() and subscribe(). Channels are kept per event
+    loop, so shards do not share them, and exist while subscribed.
+    """
+    DOMAIN = 'memory'
+    name = DOMAIN
+    MEMORY_CHANNEL_EVENT = 'memory_channel_event'
+    # key: event loop, value: {channel name: MemoryChannel}
+    _loop_channels = weakref.WeakKeyDictionary()
+
+    def __init__(self, edge, config):
+        super(MemoryInterfaceProvider, self).__init__(edge, config)
+        # key: output, value: channel subscriber of the output sink
+        self._output_subscribers = {}
+
+    @classmethod
+    def channels(cls, loop=None):
+        """Channels of loop, default the current event loop, key: name"""
+        loop = loop or asyncio.get_event_loop()
+        channels = cls._loop_channels.get(loop)
+        if channels is None:
+            channels = cls._loop_channels[loop] = {}
+        return channels
+
+    @classmethod
+    def get_channel(cls, name):
+        channels = cls.channels()
+        channel = channels.get(name)
+        if channel is None:
+            channel = channels[name] = MemoryChannel(name, channels)
+        return channel
+
+    @classmethod
+    async def publish(cls, name, payload):
+        """Publish payload on the named channel of the running loop."""
+        channel = cls.channels().get(name)
+        if channel is not None:
+            await channel.publish(payload)
+
+    @classmethod
+    def subscribe(cls, name, target, maxsize=DEFAULT_BUFFER_SIZE,
+                  policy=DEFAULT_BUFFER_POLICY):
+        """Call target (function or coroutine function) with each payload of
+        the named channel. Must be run in the event loop.
+
+        Returns the subscriber, call its unsubscribe() to stop.
+        """
+        channel = cls.get_channel(name)
+        subscriber = MemorySubscriber(channel, target, maxsize, policy)
+        channel.subscribers[subscriber] = None
+        return subscriber
+
+    @staticmethod
+    def channel_name(interface):
+        return interface.get_attrs(ATTR_CHANNEL) or \
+            "{}_{}".format(interface.component.id, interface.name)
+
+    async def async_setup(self, edge, config):
+        pass
+
+    async def conn_output_sink(self, output, output_wire_params, callback):
+        """Subscribe output sink channel, payloads go through the EventBus to
+        the wired input slots.
+        """
+        if output in self._output_subscribers:
+            return
+        event_type = "{}_{}".format(self.MEMORY_CHANNEL_EVENT, output.id)
+        self._async_listen_output(output, event_type, callback)
+
+        def fire(payload):
+            self.edge.bus.async_fire(event_type, payload)
+
+        self._output_subscribers[output] = self.subscribe(
+            self.channel_name(output), fire,
+            output.get_attrs(ATTR_BUFFER_SIZE) or DEFAULT_BUFFER_SIZE,
+            output.get_attrs(ATTR_BUFFER_POLICY) or DEFAULT_BUFFER_POLICY)
+
+    async def emit_input_slot(self, input, payload):
+        """Publish payload on the input slot channel"""
+        await self.publish(self.channel_name(input), payload)
+
+    def disconn_output_sink(self, output):
+        """ disconnect wire output sink
+        """
+        if len(output.output_wires) == 1:
+            subscriber = self._output_subscribers.pop(output, None)
+            if subscriber is not None:
+                run_callback_in_loop(self.edge.loop, subscriber.unsubscribe)
+            self._release_output(output)
@@ -1,5 +1,6 @@
 import asyncio
 import json
+import threading
 from merceedge.providers.base import ServiceProvider
 
 from merceedge.service import (
@@ -11,11 +12,15 @@ from merceedge.const import (
     EVENT_EDGE_STOP
 )
 from merceedge import util
+from merceedge.util.refcount import RefCountedRegistry
+from merceedge.util.topic import TopicTrie, validate_filter
+from merceedge.exceptions import InvalidTopicFilter
 from merceedge.util.async_util import (
     Context,
     callback,
     is_callback,
     run_callback_threadsafe,
+    run_callback_in_loop,
     run_coroutine_threadsafe,
     CALLBACK_TYPE,
     T
@@ -53,31 +58,41 @@ ATTR_RETAIN = 'retain'
 
 MAX_RECONNECT_WAIT = 300  # seconds
 
-class MqttServiceProvider(ServiceProvider):
-    DOMAIN = 'mqtt'
-    name=DOMAIN
-    SERVICE_PUBLISH = 'publish'
-    MQTT_MSG_RCV_EVENT = 'mqtt_msg_rcv'
-    
-    def __init__(self, edge, config):
-        self._paho_lock = asyncio.Lock(loop=edge.loop)
-        super(MqttServiceProvider, self).__init__(edge, config)
-        
-    async def async_setup(self, edge, attrs):
+
+class MqttConnection(object):
+    """Paho client shared by the MQTT interfaces of an edge with the same
+    broker, client id and credentials, see MqttServiceProvider.connections.
+
+    Connects once on first use. Inbound messages are fired to the EventBus
+    event of each output sink with a topic filter matching the message
+    topic, looked up in a TopicTrie.
+    """
+    def __init__(self, edge, key, options):
         self.edge = edge
-        # TODO need validate config
-        
-        # MQTT client setup
-        conf = self.config[self.DOMAIN]
-        broker = attrs.get(CONF_BROKER, conf[CONF_BROKER])
-        port = util.convert(attrs.get(CONF_PORT), int, conf.get(CONF_PORT, DEFAULT_PORT))
-        client_id = util.convert(attrs.get(CONF_CLIENT_ID), str, conf.get(CONF_CLIENT_ID))
-        keepalive = util.convert(attrs.get(CONF_KEEPALIVE), int, conf.get(CONF_KEEPALIVE, DEFAULT_KEEPALIVE))
-        username = util.convert(attrs.get(CONF_USERNAME), str, conf.get(CONF_USERNAME))
-        password = util.convert(attrs.get(CONF_PASSWORD), str, conf.get(CONF_PASSWORD))
-        certificate = util.convert(attrs.get(CONF_CERTIFICATE), str, conf.get(CONF_CERTIFICATE))
-        protocol = util.convert(attrs.get(CONF_PROTOCOL), str, conf.get(CONF_PROTOCOL, DEFAULT_PROTOCOL))
+        self.key = key
+        self.options = options
+        self._mqttc = None
+        self._connect_task = None
+        self._stopped = False
+        # Output sink event types by topic filter, data: qos
+        self.subscriptions = TopicTrie()
+        # Subscriptions are updated in the event loop, read by the paho thread
+        self._lock = threading.Lock()
+        self._remove_stop_listener = edge.bus.async_listen_once(
+            EVENT_EDGE_STOP, self.async_stop_mqtt)
+
+    async def async_connect(self):
+        """Connect the client if not connected yet.
+
+        Returns True when connected. Must be run in the event loop.
+        """
+        if self._connect_task is None:
+            self._connect_task = self.edge.loop.create_task(self._async_connect())
+        return await asyncio.shield(self._connect_task)
 
+    async def _async_connect(self):
+        options = self.options
+        protocol = options[CONF_PROTOCOL]
         if protocol not in (PROTOCOL_31, PROTOCOL_311):
             _LOGGER.error('Invalid protocol specified: %s. Allowed values: %s, %s',
                         protocol, PROTOCOL_31, PROTOCOL_311)
@@ -90,49 +105,169 @@ class MqttServiceProvider(ServiceProvider):
         else:
             proto = mqtt.MQTTv311
         
-        if client_id is None:
+        if options[CONF_CLIENT_ID] is None:
             self._mqttc = mqtt.Client(protocol=proto)
         else:
-            self._mqttc = mqtt.Client(client_id, protocol=proto)
+            self._mqttc = mqtt.Client(options[CONF_CLIENT_ID], protocol=proto)
 
-        if username is not None:
-            self._mqttc.username_pw_set(username, password)
-        if certificate is not None:
-            self._mqttc.tls_set(certificate)
+        if options[CONF_USERNAME] is not None:
+            self._mqttc.username_pw_set(options[CONF_USERNAME], options[CONF_PASSWORD])
+        if options[CONF_CERTIFICATE] is not None:
+            self._mqttc.tls_set(options[CONF_CERTIFICATE])
 
-        # self._mqttc.on_subscribe = self._mqtt_on_subscribe
-        # self._mqttc.on_unsubscribe = self._mqtt_on_unsubscribe
-        # self._mqttc.on_connect = self._mqtt_on_connect
-        # self._mqttc.on_disconnect = self._mqtt_on_disconnect
         self._mqttc.on_message = self._mqtt_on_message
-        self._mqttc.on_publish  = self.on_publish 
 
-        result = await self.edge.async_add_job(
-                    self._mqttc.connect, broker, port, keepalive
-        )
+        try:
+            result = await self.edge.async_add_job(
+                        self._mqttc.connect, options[CONF_BROKER], options[CONF_PORT],
+                        options[CONF_KEEPALIVE])
+        except OSError as e:
+            _LOGGER.error("Failed to connect to %s: %s", options[CONF_BROKER], e)
+            return False
         
         if result != 0:
-            import paho.mqtt.client as mqtt
             _LOGGER.error("Failed to connect: %s", mqtt.error_string(result))
             return False
         
         self._mqttc.loop_start()
-       
-        self.edge.bus.async_listen_once(EVENT_EDGE_STOP, self.async_stop_mqtt)
+        return True
 
-    async def async_stop_mqtt(self, event):
-        """Stop the MQTT client.
+    def _add_subscription(self, topic, qos, event_type):
+        """Return True if topic was not subscribed yet."""
+        with self._lock:
+            return self.subscriptions.add(topic, event_type, qos)
 
-        This method must be run in the event loop and returns a coroutine.
+    def _remove_subscription(self, topic, event_type):
+        """Return True if topic has no subscriber left."""
+        with self._lock:
+            return self.subscriptions.remove(topic, event_type)
+
+    async def async_subscribe(self, topic, qos, event_type):
+        """Fire event_type with the messages of topic, the broker
+        subscription is shared by the output sinks of the topic.
         """
-        def stop():
-            """Stop the MQTT client."""
+        if not await self.async_connect():
+            return
+        if self._add_subscription(topic, qos, event_type):
+            _LOGGER.debug("Subscribing to %s", topic)
+            await self.edge.async_add_job(self._mqttc.subscribe, topic, qos)
+
+    def unsubscribe(self, topic, event_type):
+        if self._remove_subscription(topic, event_type) and self._mqttc is not None:
+            self._mqttc.unsubscribe(topic)
+
+    async def async_publish(self, topic, payload, qos, retain):
+        if not await self.async_connect():
+            return
+        _LOGGER.debug("Transmitting message on %s: %s", topic, payload)
+        await self.edge.async_add_job(
+            self._mqttc.publish, topic, payload, qos, retain)
+
+    def _mqtt_on_message(self, _mqttc, _userdata, msg):
+        with self._lock:
+            event_types = self.subscriptions.match(msg.topic)
+        if not event_types:
+            return
+        payload = msg.payload.decode('utf-8')
+        for event_type in event_types:
+            self.edge.bus.fire(event_type, payload)
+
+    def _stop(self):
+        """Stop the MQTT client."""
+        if self._mqttc is not None:
             self._mqttc.disconnect()
             self._mqttc.loop_stop()
+
+    def close(self):
+        """Disconnect once the last interface released the connection.
+        Wires are deleted from the REST API thread too, the connection is
+        closed in the edge loop.
+        """
+        run_callback_in_loop(self.edge.loop, self._async_close)
+
+    @callback
+    def _async_close(self):
+        """Disconnect the client.
+
+        This method must be run in the event loop.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._remove_stop_listener()
+        if self._connect_task is not None and not self._connect_task.done():
+            self._connect_task.cancel()
+        self.edge.async_add_job(self._stop)
+
+    async def async_stop_mqtt(self, event):
+        """Stop the MQTT client on edge stop.
+
+        This method must be run in the event loop and returns a coroutine.
+        """
         print("mqtt provider aborting...")
-        await self.edge.async_add_job(stop)
+        self._stopped = True
+        MqttServiceProvider.connections.discard(self.key)
+        await self.edge.async_add_job(self._stop)
+
+
+class MqttServiceProvider(ServiceProvider):
+    """MQTT interfaces. One provider per interface, the interfaces share
+    pooled MqttConnection clients keyed by edge, broker, port, client id and
+    credentials.
+    """
+    DOMAIN = 'mqtt'
+    name=DOMAIN
+    SERVICE_PUBLISH = 'publish'
+    MQTT_MSG_RCV_EVENT = 'mqtt_msg_rcv'
+    # key: connection key, value: MqttConnection
+    connections = RefCountedRegistry()
+    
+    def __init__(self, edge, config):
+        super(MqttServiceProvider, self).__init__(edge, config)
+        self.connection = None
+        self._connection_key = None
+        # key: output, value: (topic, event type)
+        self._subscriptions = {}
+
+    def _connection_options(self, attrs):
+        # TODO need validate config
+        conf = self.config[self.DOMAIN]
+        return {
+            CONF_BROKER: attrs.get(CONF_BROKER, conf[CONF_BROKER]),
+            CONF_PORT: util.convert(attrs.get(CONF_PORT), int, conf.get(CONF_PORT, DEFAULT_PORT)),
+            CONF_CLIENT_ID: util.convert(attrs.get(CONF_CLIENT_ID), str, conf.get(CONF_CLIENT_ID)),
+            CONF_KEEPALIVE: util.convert(attrs.get(CONF_KEEPALIVE), int,
+                                         conf.get(CONF_KEEPALIVE, DEFAULT_KEEPALIVE)),
+            CONF_USERNAME: util.convert(attrs.get(CONF_USERNAME), str, conf.get(CONF_USERNAME)),
+            CONF_PASSWORD: util.convert(attrs.get(CONF_PASSWORD), str, conf.get(CONF_PASSWORD)),
+            CONF_CERTIFICATE: util.convert(attrs.get(CONF_CERTIFICATE), str, conf.get(CONF_CERTIFICATE)),
+            CONF_PROTOCOL: util.convert(attrs.get(CONF_PROTOCOL), str,
+                                        conf.get(CONF_PROTOCOL, DEFAULT_PROTOCOL))
+        }
+
+    def get_connection(self, attrs):
+        """Pooled connection of the interface attrs, acquired on first call.
+
+        This method must be run in the event loop.
+        """
+        if self.connection is None:
+            options = self._connection_options(attrs)
+            key = (self.edge, ) + tuple(sorted(options.items()))
+            self.connection = self.connections.acquire(
+                key, lambda: MqttConnection(self.edge, key, options))
+            self._connection_key = key
+        return self.connection
+
+    def _release_connection(self):
+        if self.connection is not None:
+            self.connection = None
+            self.connections.release(self._connection_key, MqttConnection.close)
+        
+    async def async_setup(self, edge, attrs):
+        self.edge = edge
+        await self.get_connection(attrs).async_connect()
             
-    async def async_publish(self, data):
+    async def async_publish(self, connection, data):
         """Handle MQTT publish service calls."""
         msg_topic = data.get(ATTR_TOPIC)
         payload = data.get(ATTR_PAYLOAD)
@@ -150,10 +285,7 @@ class MqttServiceProvider(ServiceProvider):
         if msg_topic is None or payload is None:
             return
 
-        # async with self._paho_lock:
-        _LOGGER.debug("Transmitting message on %s: %s", msg_topic, payload)
-        await self.edge.async_add_job(
-            self._mqttc.publish, msg_topic, payload, qos, retain)
+        await connection.async_publish(msg_topic, payload, qos, retain)
         
 
     def _build_publish_data(self, topic, qos, retain, payload=None):
@@ -168,33 +300,39 @@ class MqttServiceProvider(ServiceProvider):
         data[ATTR_PAYLOAD] = payload
         return data
 
-    def on_publish(self, client, obj, mid):
-        # print("mqtt publish: " + str(mid))
-        pass
-
-    def _mqtt_on_message(self, _mqttc, _userdata, msg):
-        self.edge.bus.fire(self.event_type, msg.payload.decode('utf-8'))
-
     async def conn_output_sink(self, output, output_wire_params, callback):                       
         # mqtt client subscribe topic 
-        qos = output.get_attrs(ATTR_QOS, DEFAULT_QOS)
+        if output in self._subscriptions:
+            return
+        qos = util.convert(output.get_attrs(ATTR_QOS), int, DEFAULT_QOS)
         topic = output.get_attrs(ATTR_TOPIC)
-        _LOGGER.debug("Subscribing to %s", topic)
-
-        # async with self._paho_lock:
-        result, _ = await self.edge.async_add_job(
-            self._mqttc.subscribe, topic, qos)
+        try:
+            validate_filter(topic)
+        except InvalidTopicFilter as e:
+            _LOGGER.error(str(e))
+            return
         
         # Subscribe callback -> EventBus -> Wire input (output sink ) -> EventBus(Send) -> Service provider  
         event_type = "{}_{}".format(self.MQTT_MSG_RCV_EVENT, output.id)
-        self.event_type = event_type
-        self.edge.bus.listen(event_type, callback)
+        self._subscriptions[output] = (topic, event_type)
+        self._async_listen_output(output, event_type, callback)
+        await self.get_connection(output.attrs).async_subscribe(topic, qos, event_type)
 
     def disconn_output_sink(self, output):
         """ disconnect wire output sink
         """
         if len(output.output_wires) == 1:
-            self._mqttc.unsubscribe(output.get_attrs('topic'))
+            subscription = self._subscriptions.pop(output, None)
+            if subscription is not None and self.connection is not None:
+                self.connection.unsubscribe(*subscription)
+            self._release_output(output)
+            self._release_connection()
+
+    def disconn_input_slot(self, input):
+        """ disconnect wire input slot
+        """
+        if len(input.input_wires) == 1:
+            self._release_connection()
         
     async def emit_input_slot(self, input, payload):
         """Publish message to an MQTT topic."""
@@ -204,4 +342,4 @@ class MqttServiceProvider(ServiceProvider):
                                         payload)
         
         # print("mqtt emit_input_slot")
-        await self.async_publish(data)
+        await self.async_publish(self.get_connection(input.attrs), data)
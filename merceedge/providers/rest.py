@@ -56,13 +56,13 @@ class RestApiProvider(ServiceProvider):
     
     async def async_setup(self, edge, config):
         # setup request timer
-        self.remove_request_timer_handler = self.edge.bus.async_listen(EVENT_TIME_CHANGED, self.request_timer_handler)
+        self._async_listen(EVENT_TIME_CHANGED, self.request_timer_handler)
 
-        self.edge.bus.async_listen_once(EVENT_EDGE_STOP, self.async_stop_rest)
+        self._async_listen(EVENT_EDGE_STOP, self.async_stop_rest, once=True)
     
     async def async_stop_rest(self, event):
         print("rest provider aborting...")
-        self.remove_request_timer_handler()
+        self._release_listeners(EVENT_EDGE_STOP)
 
     def _new_requester_setup(self, output, output_wire_params, response_handler):
         """ Read input or output interface config(swagger 2.0 standard compliant).
@@ -72,7 +72,7 @@ class RestApiProvider(ServiceProvider):
         operation = self._get_request_attrs(output, output_wire_params)
         # logger.info(u'regisiter requester {0} {1}'.format(request_action.upper(), url))
         self.event_type = "{}_{}".format(self.REST_REQUEST_EVNET, output.id)
-        self.edge.bus.async_listen(self.event_type, response_handler)
+        self._async_listen_output(output, self.event_type, response_handler)
         self._requesters[output.get_attrs('operationId')] = \
                                                         (operation, 
                                                         response_handler)
@@ -152,8 +152,10 @@ class RestApiProvider(ServiceProvider):
     def disconn_output_sink(self, output):
         """ disconnect wire output sink
         """
-        # Delete timer handler
-        self.remove_request_timer_handler()
+        self._release_output(output)
+        # Delete timer handler once no output is connected
+        if not self._output_listeners:
+            self._release_listeners()
     
     async def emit_input_slot(self, input, payload):
         """send data to input slot, for rest api, invoide corotutine request.
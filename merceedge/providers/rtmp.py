@@ -1,9 +1,17 @@
-from threading import Thread
-import cv2
+import heapq
+import itertools
+import os
+import threading
 import numpy as np
-import time
+try:
+    import cv2
+except ImportError:  # decoding needs OpenCV, pacing and scheduling do not
+    cv2 = None
+from time import monotonic
 
 from merceedge.providers.base import ServiceProvider
+from merceedge.util.frame_ring import FrameRing, DEFAULT_RING_SLOTS
+from merceedge.util.refcount import RefCountedRegistry
 from merceedge.const import EVENT_EDGE_STOP
 from merceedge.settings import (
     logger_access,
@@ -13,66 +21,316 @@ from merceedge.settings import (
 
 _LOGGER = logger_code
 
+ATTR_RTMP_URL = 'rtmp_url'
+ATTR_RING_SLOTS = 'ring_slots'
+# Pace frames at a target fps, default follows file timestamps, live streams
+# are not paced
+ATTR_FPS = 'fps'
+# Decode continuously, only the newest frame waits until the consumers
+# are ready
+ATTR_LATEST_FRAME = 'latest_frame'
+# How often a latest frame checks again for ready consumers
+LATEST_FRAME_RETRY = 0.005  # seconds
+
+# User config: rtmp: decode_workers, threads decoding all the streams
+CONF_DECODE_WORKERS = 'decode_workers'
+DEFAULT_DECODE_WORKERS = os.cpu_count() or 1
+
+LIVE_STREAM_SCHEMES = ('rtmp://', 'rtsp://', 'http://', 'https://', 'udp://', 'tcp://')
+
+
+class FramePacer(object):
+    """Delivery time of frames: every 1/fps seconds, or at the stream
+    position of the frame (file sources), or as soon as decoded (live
+    streams).
+    """
+    def __init__(self, fps=None, use_timestamps=False):
+        self.interval = 1.0 / fps if fps else None
+        self.use_timestamps = use_timestamps
+        self._due = None
+        self._start = None
+
+    def due(self, position_ms=None):
+        """Return monotonic time the frame at position_ms is due."""
+        now = monotonic()
+        if self.interval is not None:
+            # Do not burst to catch up when the decoder fell behind
+            if self._due is None or now - self._due > self.interval:
+                self._due = now
+            else:
+                self._due += self.interval
+        elif self.use_timestamps and position_ms is not None:
+            if self._start is None:
+                self._start = now - position_ms / 1000
+            self._due = self._start + position_ms / 1000
+        else:
+            self._due = now
+        return self._due
+
+
+class RTMPStream(object):
+    """Decoding state of one output sink stream. Decoded by one pool worker
+    at a time: each step delivers the frame decoded ahead, then decodes the
+    next one.
+    """
+    def __init__(self, edge, output, event_type):
+        self.edge = edge
+        self.output = output
+        self.output_id = output.id
+        self.event_type = event_type
+        self.url = output.get_attrs(ATTR_RTMP_URL)
+        self.slots = int(output.get_attrs(ATTR_RING_SLOTS) or DEFAULT_RING_SLOTS)
+        fps = output.get_attrs(ATTR_FPS)
+        self.pacer = FramePacer(float(fps) if fps else None,
+                                use_timestamps=not self._is_live(self.url))
+        self.latest_frame = bool(output.get_attrs(ATTR_LATEST_FRAME))
+        self.stopped = False
+        self._capture = None
+        self._ring = None
+        self._next_frame = None
+        # Latest frame mode: newest frame waiting for delivery on the loop
+        self._pending_frame = None
+        self._delivery_scheduled = False
+        self.stats = {
+            'url': self.url,
+            'decoded': 0,
+            'delivered': 0,
+            'replaced': 0,
+            'decode_seconds': 0.0,
+            'finished': False,
+            'error': None
+        }
+
+    @staticmethod
+    def _is_live(rtmp_url):
+        return not isinstance(rtmp_url, str) or rtmp_url.startswith(LIVE_STREAM_SCHEMES)
+
+    def step(self):
+        """Deliver the frame decoded ahead, decode the next one.
+
+        Returns the time the next frame is due, None at the end of stream.
+        """
+        if self._next_frame is not None:
+            self._deliver(self._next_frame)
+            self._next_frame = None
+        if self._capture is None:
+            self._capture = cv2.VideoCapture(self.url)
+        start = monotonic()
+        frame = self._read()
+        self.stats['decode_seconds'] += monotonic() - start
+        if frame is None:
+            return None
+        self.stats['decoded'] += 1
+        self._next_frame = frame
+        return self.pacer.due(self._capture.get(cv2.CAP_PROP_POS_MSEC))
+
+    def _read(self):
+        """Decode the next frame into the ring, return its RingFrame."""
+        ring = self._ring
+        if ring is not None:
+            slot = ring.write_slot()
+            grabbed, frame = self._capture.read(slot)
+        else:
+            slot = None
+            grabbed, frame = self._capture.read()
+        # if the frame was not grabbed, then we have reached the end
+        # of the stream
+        if not grabbed:
+            return None
+        if ring is None or frame.shape != ring.shape:
+            if ring is not None:
+                ring.close()
+            ring = self._ring = FrameRing(frame.shape, frame.dtype, self.slots)
+            slot = ring.write_slot()
+        if frame is not slot:
+            # Decoder did not write in place
+            slot[...] = frame
+        return ring.commit()
+
+    def _deliver(self, frame):
+        self.stats['delivered'] += 1
+        if not self.latest_frame:
+            self.edge.bus.fire(self.event_type, frame)
+            return
+        # Replace the frame waiting for delivery, only the first frame of a
+        # delivery wakes up the event loop.
+        if self._pending_frame is not None:
+            self.stats['replaced'] += 1
+        self._pending_frame = frame
+        if not self._delivery_scheduled:
+            self._delivery_scheduled = True
+            self.edge.loop.call_soon_threadsafe(self._async_deliver_latest_frame)
+
+    def _consumers_ready(self):
+        """True when every wireload fed by the output waits for a payload,
+        other consumers are always ready.
+        """
+        for wire in list(self.output.output_wires.values()):
+            queue = getattr(wire.input_slot.component, 'input_q', None)
+            if queue is not None and not queue.has_waiting_consumer():
+                return False
+        return True
+
+    def _async_deliver_latest_frame(self):
+        if self._pending_frame is not None and not self.stopped and \
+                not self._consumers_ready():
+            # Newer frames replace the pending one meanwhile
+            self.edge.loop.call_later(LATEST_FRAME_RETRY, self._async_deliver_latest_frame)
+            return
+        self._delivery_scheduled = False
+        frame, self._pending_frame = self._pending_frame, None
+        if frame is not None and not self.stopped:
+            self.edge.bus.async_fire(self.event_type, frame)
+
+    def close(self):
+        self.stats['finished'] = True
+        self._next_frame = None
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+
+
+class DecodePool(object):
+    """Bounded pool of threads decoding many streams. Streams are scheduled
+    by the time their next frame is due, earliest first.
+    """
+    def __init__(self, workers=DEFAULT_DECODE_WORKERS):
+        self.workers = workers
+        self._heap = []  # (due, order, stream)
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def add(self, stream):
+        with self._cond:
+            heapq.heappush(self._heap, (monotonic(), next(self._order), stream))
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run,
+                                          name="RTMPDecode-{}".format(len(self._threads)),
+                                          daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+
+    def stop(self):
+        """Stop the threads and close the streams, a stream being decoded
+        is closed by its thread once the step is done.
+        """
+        with self._cond:
+            self._stopped = True
+            streams = [stream for _, _, stream in self._heap]
+            self._heap = []
+            self._cond.notify_all()
+        for stream in streams:
+            stream.close()
+
+    def _next_stream(self):
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due = self._heap[0][0]
+                delay = due - monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                return heapq.heappop(self._heap)[2]
+
+    def _run(self):
+        while True:
+            stream = self._next_stream()
+            if stream is None:
+                print('rtmp provider thread exit')
+                return
+            if stream.stopped:
+                stream.close()
+                continue
+            try:
+                due = stream.step()
+            except Exception as e:  # pylint: disable=broad-except
+                _LOGGER.error("RTMP stream {} decode error: {}".format(stream.url, e))
+                stream.stats['error'] = str(e)
+                due = None
+            if due is not None:
+                with self._cond:
+                    if not self._stopped:
+                        heapq.heappush(self._heap, (due, next(self._order), stream))
+                        self._cond.notify()
+                        continue
+            stream.close()
+
+
 class RTMPProvider(ServiceProvider):
     """ Receive video stream from rtmp url and convert to video frame data.
+
+    Streams of all output sinks are decoded by one shared DecodePool,
+    stopped once no provider streams anymore.
     """
     DOMAIN = "rtmp"
     name=DOMAIN
     RTMP_FRAME_EVENT = 'rtmp_frame'
+    # The shared DecodePool, key: DOMAIN
+    decode_pools = RefCountedRegistry()
 
     def __init__(self, edge, config):
         super(RTMPProvider, self).__init__(edge, config)
-        self.abort_immediately = False
-        self.t = None
+        self.streams = {}  # key: output id
+        self._decode_pool = None
+
+    def _acquire_decode_pool(self):
+        if self._decode_pool is None:
+            workers = (self.config.get(self.DOMAIN) or {}).get(CONF_DECODE_WORKERS,
+                                                               DEFAULT_DECODE_WORKERS)
+            self._decode_pool = self.decode_pools.acquire(
+                self.DOMAIN, lambda: DecodePool(int(workers)))
+        return self._decode_pool
+
+    def _release_decode_pool(self):
+        if self._decode_pool is not None:
+            self._decode_pool = None
+            self.decode_pools.release(self.DOMAIN, DecodePool.stop)
 
     async def async_setup(self, edge, config):
         _LOGGER.debug("async setup: {}".format(self.name))
-        self.edge.bus.async_listen_once(EVENT_EDGE_STOP, self.async_stop_rtmp)
-    
+        self._async_listen(EVENT_EDGE_STOP, self.async_stop_rtmp, once=True)
+
     async def async_stop_rtmp(self, event):
         """Stop RTMP."""
         print("rtmp provider aborting...")
-        self.abort_immediately = True
-    
-    def _rtmp_pull_stream(self, rtmp_id, rtmp_url, params, callback):
-        """
-            TODO user params
-        """
-        stream = cv2.VideoCapture(rtmp_url)
-        while True:
-            
-            if self.abort_immediately:
-                print('rtmp provider thread exit')
-                return
-            grabbed, frame = stream.read()
-            # if the frame was not grabbed, then we have reached the end
-            # of the stream
-            if not grabbed:
-                break
-            
-            time.sleep(0.08)
-            # callback(frame)
-            self.edge.bus.async_fire("{}_{}".format(self.RTMP_FRAME_EVENT, self.output.id), frame)
-            
-
-    def _new_rtmp_client(self, rtmp_id, rtmp_url, params, callback):
-        # Setup a thread, read rtmp urls   
-        if self.t is None:
-            self.t = Thread(target=self._rtmp_pull_stream, 
-                            args=(rtmp_id, rtmp_url, params, callback),
-                            daemon=True)
-            self.t.start()
-    
+        for stream in self.streams.values():
+            stream.stopped = True
+        self.streams = {}
+        self._release_decode_pool()
+        self._release_listeners(EVENT_EDGE_STOP)
+
+    def output_stats(self, output):
+        """Decode stats of the output stream"""
+        stream = self.streams.get(output.id)
+        return dict(stream.stats) if stream is not None else None
+
     def disconn_output_sink(self, output):
         """ disconnect wire output sink
         """
         if len(output.output_wires) == 1:
-            self.abort_immediately = True
-            self.t = None
+            stream = self.streams.pop(output.id, None)
+            if stream is not None:
+                stream.stopped = True
+            self._release_output(output)
+            if not self.streams:
+                self._release_decode_pool()
+                self._release_listeners()
 
-    async def conn_output_sink(self, output, output_wire_params, callback):       
-        rtmp_id = output.id
-        rtmp_url = output.get_attrs('rtmp_url')
-        self.output = output
-        self.edge.bus.async_listen("{}_{}".format(self.RTMP_FRAME_EVENT, output.id), callback)
-        self._new_rtmp_client(rtmp_id, rtmp_url, output_wire_params, callback)
\ No newline at end of file
+    async def conn_output_sink(self, output, output_wire_params, callback):
+        if output.id in self.streams:
+            return
+        event_type = "{}_{}".format(self.RTMP_FRAME_EVENT, output.id)
+        self._async_listen_output(output, event_type, callback)
+        stream = self.streams[output.id] = RTMPStream(self.edge, output, event_type)
+        self._acquire_decode_pool().add(stream)
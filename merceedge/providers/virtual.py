@@ -6,6 +6,7 @@ class VirtualInterfaceProvider(ServiceProvider):
     DOMAIN = 'virtual'
     name=DOMAIN
     VIRTUAL_WIRE_EVENT = "virtual_wire_event"
+    queues_payload_objects = True
 
     def __init__(self, edge, config):
         """
@@ -25,9 +26,11 @@ class VirtualInterfaceProvider(ServiceProvider):
         # 虚拟连线输出事件监听注册
         # print("virtual conn_output_sink***********")
         self.output = output
-        self.edge.bus.async_listen("{}_{}_{}".format(self.VIRTUAL_WIRE_EVENT, 
-                                                     output.component.id,
-                                                    output.name), callback)
+        self._async_listen_output(output,
+                                  "{}_{}_{}".format(self.VIRTUAL_WIRE_EVENT,
+                                                    output.component.id,
+                                                    output.name),
+                                  callback)
 
     async def conn_input_slot(self, input, input_wire_params):
         """connect input interface on wire input slot """
@@ -40,7 +43,8 @@ class VirtualInterfaceProvider(ServiceProvider):
         # if self.output:
         #     await input.component.emit_output_payload("{}_{}".format(self.VIRTUAL_WIRE_EVENT, self.output.id))
 
-    async def disconn_output_sink(self, output):
+    def disconn_output_sink(self, output):
         """ disconnect wire output sink
         """
-        raise NotImplementedError
+        if len(output.output_wires) == 1:
+            self._release_output(output)
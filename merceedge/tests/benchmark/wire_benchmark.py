@@ -0,0 +1,224 @@
+"""
+MerceEdge wire data plane benchmark.
+
+Runs offline, no broker needed:
+- bus: EventBus dispatch on a MockEdge, each event to fanout listeners.
+- wire: synthetic formula on a MerceEdge wired with the virtual provider,
+  components pipelines of a source wireload fanning out to fanout chains of
+  depth pass through wireloads.
+
+Prints one JSON document: parameters, then msgs/s, p50/p99 latency, CPU
+seconds and max RSS of each scenario.
+
+Usage:
+    python -m merceedge.tests.benchmark.wire_benchmark --messages 10000 \
+        --components 2 --fanout 2 --depth 3 --payload-size 256 -o result.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import sys
+from time import monotonic
+
+from merceedge.core import MerceEdge, WireLoad
+from merceedge.util.async_util import callback
+from merceedge.util.mock import MockEdge
+from merceedge.providers import ServiceProviderFactory
+from merceedge.providers.virtual import VirtualInterfaceProvider
+
+# Let the loop run the scheduled jobs every N fired messages
+YIELD_EVERY = 100
+
+
+def _template(name):
+    return {
+        'component': {
+            'name': name,
+            'virtual': True,
+            'inputs': [{'name': 'input', 'protocol': {'name': 'virtual'}}],
+            'outputs': [{'name': 'output', 'protocol': {'name': 'virtual'}}]
+        }
+    }
+
+
+class PassThroughWireLoad(WireLoad):
+    name = 'benchmark_pass_through'
+
+    async def process(self, input_payload):
+        await self.put_output_payload('output', input_payload)
+
+
+class SinkWireLoad(WireLoad):
+    name = 'benchmark_sink'
+
+    def __init__(self, edge, model_template_config, component_id=None, init_params=None):
+        super(SinkWireLoad, self).__init__(edge, model_template_config, component_id, init_params)
+        self.latencies = []
+        self.done = None
+
+    async def process(self, input_payload):
+        self.latencies.append(monotonic() - input_payload['ts'])
+        if len(self.latencies) == self.expected:
+            self.done.set_result(None)
+
+
+class _Measure(object):
+    """CPU time and wall clock of a scenario."""
+    def __enter__(self):
+        self._usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._start = monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = monotonic() - self._start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = (usage.ru_utime - self._usage.ru_utime) + \
+            (usage.ru_stime - self._usage.ru_stime)
+        # kilobytes on Linux
+        self.max_rss_kb = usage.ru_maxrss
+
+
+def _percentile(values, percent):
+    """Percentile of values, None without samples."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def _percentile_ms(values, percent):
+    """Percentile of latencies in milliseconds, None (null in the JSON
+    report) without samples, eg. when no message was delivered.
+    """
+    value = _percentile(values, percent)
+    return value * 1000 if value is not None else None
+
+
+def _result(messages, deliveries, latencies, measure):
+    return {
+        'messages': messages,
+        'deliveries': deliveries,
+        'seconds': measure.wall,
+        'msgs_per_sec': deliveries / measure.wall if measure.wall else None,
+        'latency_p50_ms': _percentile_ms(latencies, 50),
+        'latency_p99_ms': _percentile_ms(latencies, 99),
+        'cpu_seconds': measure.cpu,
+        'max_rss_kb': measure.max_rss_kb
+    }
+
+
+def bench_bus(messages, fanout, payload_size):
+    """Fire messages through the EventBus to fanout callback listeners."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    edge = MockEdge({})
+    latencies = []
+    data = b'x' * payload_size
+
+    @callback
+    def listener(event):
+        latencies.append(monotonic() - event.data['ts'])
+
+    async def run():
+        for _ in range(fanout):
+            edge.bus.async_listen('benchmark_event', listener)
+        with _Measure() as measure:
+            for index in range(messages):
+                edge.bus.async_fire('benchmark_event', {'ts': monotonic(), 'data': data})
+                if index % YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+            while len(latencies) < messages * fanout:
+                await asyncio.sleep(0)
+        return measure
+
+    measure = loop.run_until_complete(run())
+    loop.close()
+    return _result(messages, len(latencies), latencies, measure)
+
+
+def bench_wire(messages, components, fanout, depth, payload_size):
+    """Drive messages through synthetic wireload pipelines."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    edge = MerceEdge({'wireload': {'paths': []}}, loop=loop)
+    ServiceProviderFactory.provider_classes['virtual'] = VirtualInterfaceProvider
+    ServiceProviderFactory.edge = edge
+    data = b'x' * payload_size
+
+    def add(wireload_class):
+        wireload = wireload_class(edge, _template(wireload_class.name))
+        edge.components[wireload.id] = wireload
+        return wireload
+
+    async def connect(output_com, input_com):
+        await edge.connect_interface(output_com.id, 'output', input_com.id, 'input')
+
+    async def run():
+        sources, sinks = [], []
+        for _ in range(components):
+            source = add(PassThroughWireLoad)
+            sources.append(source)
+            for _ in range(fanout):
+                previous = source
+                for _ in range(depth):
+                    stage = add(PassThroughWireLoad)
+                    await connect(previous, stage)
+                    previous = stage
+                sink = add(SinkWireLoad)
+                sink.expected = messages
+                sink.done = loop.create_future()
+                await connect(previous, sink)
+                sinks.append(sink)
+
+        with _Measure() as measure:
+            for index in range(messages):
+                for source in sources:
+                    await source.put_output_payload(
+                        'output', {'ts': monotonic(), 'data': data})
+                if index % YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+            await asyncio.gather(*[sink.done for sink in sinks])
+        edge.stop_wireload_exec()
+        return measure, [latency for sink in sinks for latency in sink.latencies]
+
+    measure, latencies = loop.run_until_complete(run())
+    loop.close()
+    return _result(messages * components, len(latencies), latencies, measure)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--components', type=int, default=1,
+                        help='number of source pipelines')
+    parser.add_argument('--fanout', type=int, default=1)
+    parser.add_argument('--depth', type=int, default=3,
+                        help='pass through wireloads per chain')
+    parser.add_argument('--payload-size', type=int, default=256)
+    parser.add_argument('--scenario', choices=['all', 'bus', 'wire'], default='all')
+    parser.add_argument('-o', '--output', help='write JSON result to file')
+    args = parser.parse_args(argv)
+
+    result = {
+        'parameters': vars(args),
+        'python': sys.version.split()[0],
+        'platform': platform.platform()
+    }
+    if args.scenario in ('all', 'bus'):
+        result['bus'] = bench_bus(args.messages, args.fanout, args.payload_size)
+    if args.scenario in ('all', 'wire'):
+        result['wire'] = bench_wire(args.messages, args.components, args.fanout,
+                                    args.depth, args.payload_size)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
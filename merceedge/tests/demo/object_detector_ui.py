@@ -5,6 +5,7 @@ import cv2
 import numpy as np
 import time
 from merceedge.tests.detect_object.utils.app_utils import FPS
+from merceedge.util.frame_codec import decode_frame
 
 broker = '127.0.0.1'
 port = 1883
@@ -15,14 +16,7 @@ frame = None
 input_q = Queue()  # fps is better if queue is higher but then more lags
 
 def _mqtt_on_message(_mqttc, _userdata, msg):
-    global width, height
-
-    if msg.topic == u'/mercedge/rtmp_video_size':
-        size = json.loads(msg.payload.decode('utf-8'))
-        width = size['width']
-        height = size['height']
-
-    elif msg.topic == u'/mercedge/rtmp_bytes':
+    if msg.topic == u'/mercedge/rtmp_bytes':
         input_q.put(('rtmp_bytes', msg.payload))
 
     elif msg.topic == u'/mercedge/object_detection_result':
@@ -35,7 +29,6 @@ _mqttc.loop_start()
 
 
 def main():
-    _mqttc.subscribe('/mercedge/rtmp_video_size', 0)
     _mqttc.subscribe('/mercedge/rtmp_bytes', 0)
     _mqttc.subscribe('/mercedge/object_detection_result', 0)
     # fps = FPS().start()
@@ -43,11 +36,6 @@ def main():
 
         t = time.time()
         global width, height
-        if width == 0 or height == 0:
-            # print('waiting video size parameters', width, height)
-            continue
-        
-
         if input_q.empty():
             pass
         else:
@@ -56,8 +44,11 @@ def main():
             
             if payload[0] == 'rtmp_bytes':
                 
-                frame_bytes = payload[1]
-                frame = np.frombuffer(frame_bytes, dtype=np.uint8).reshape(height, width, 3)
+                # Encoded frames carry their size in the header
+                header, frame = decode_frame(payload[1])
+                height, width = header.height, header.width
+                if not frame.flags.writeable:
+                    frame = frame.copy()
 
             elif payload[0] == 'object_detection_result':
                 
@@ -0,0 +1,1172 @@
+# MerceEdge core data plane unit test case
+import asyncio
+import os
+import pickle
+import signal
+import threading
+from time import monotonic
+
+import numpy as np
+import pytest
+
+from merceedge.core import (
+    MerceEdge,
+    Component,
+    Wire,
+    WireLoad,
+    JobType,
+    Event
+)
+import merceedge.util.dt as dt_util
+import merceedge.util.graph as graph_util
+import merceedge.util.metrics as metrics_util
+from merceedge.util.backpressure import WireQueue
+from merceedge.util.frame_ring import FrameRing
+from merceedge.util.process_worker import (
+    ProcessWorker,
+    SharedArrayChannel,
+    SHARED_ARRAY_MIN_BYTES
+)
+from merceedge.util.frame_codec import encode_frame, decode_frame, HEADER_SIZE
+from merceedge.util.refcount import RefCountedRegistry
+from merceedge.util.topic import TopicTrie
+from merceedge.util.async_util import callback, run_coroutine_threadsafe
+from merceedge.const import MATCH_ALL, EVENT_EDGE_STOP
+from merceedge.exceptions import InvalidFrame, InvalidTopicFilter, ProcessWorkerError
+from merceedge.providers import ServiceProviderFactory
+from merceedge.providers.virtual import VirtualInterfaceProvider
+from merceedge.providers.memory import MemoryInterfaceProvider
+from merceedge.providers.mqtt import MqttServiceProvider
+from merceedge.providers.rtmp import RTMPProvider, FramePacer, RTMPStream, DecodePool
+
+__config__ = {
+    "wireload": {
+        "paths": []
+    }
+}
+
+component_template = {
+    "component": {
+        "name": "test_component",
+        "inputs": [{"name": "test_input", "protocol": {"name": "test"}}],
+        "outputs": [{"name": "test_output", "protocol": {"name": "test"}}]
+    }
+}
+
+
+class MockEvent:
+    def __init__(self, data):
+        self.data = data
+        self._context = None
+
+
+def new_edge():
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    return MerceEdge(__config__)
+
+
+def test_wire_route():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    input_com = Component(edge, component_template)
+    output_sink = output_com.outputs["test_output"]
+    input_slot = input_com.inputs["test_input"]
+
+    received = []
+    async def emit_data_to_input(event, trace=None):
+        received.append(event.data)
+    input_slot.emit_data_to_input = emit_data_to_input
+
+    async def run():
+        wire = Wire(edge, output_sink, input_slot)
+        wire.connect()
+        output_sink.output_sink_callback(MockEvent("payload"))
+        await edge.async_block_till_done()
+        assert received == ["payload"]
+
+        edge.remove_wire_route(wire)
+        output_sink.output_sink_callback(MockEvent("payload"))
+        await edge.async_block_till_done()
+        assert received == ["payload"]
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_bus_fire_ingress_batch():
+    edge = new_edge()
+    received = []
+    drains = []
+
+    @callback
+    def listener(event):
+        received.append(event.data)
+
+    drain_ingress = edge.bus._async_drain_ingress
+    def count_drain():
+        drains.append(len(edge.bus._ingress))
+        drain_ingress()
+    edge.bus._async_drain_ingress = count_drain
+
+    async def run():
+        edge.bus.async_listen("test_event", listener)
+        producer = threading.Thread(
+            target=lambda: [edge.bus.fire("test_event", i) for i in range(100)])
+        producer.start()
+        producer.join()
+        await edge.async_block_till_done()
+        await asyncio.sleep(0)
+        assert received == list(range(100))
+        assert len(drains) < 100
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_bus_listener_job_types():
+    edge = new_edge()
+    received = []
+
+    @callback
+    def callback_listener(event):
+        received.append(("callback", event.data))
+
+    async def coroutine_listener(event):
+        received.append(("coroutine", event.data))
+
+    def executor_listener(event):
+        received.append(("executor", event.data))
+
+    async def run():
+        edge.bus.async_listen("test_event", callback_listener)
+        edge.bus.async_listen("test_event", coroutine_listener)
+        edge.bus.async_listen_once("test_event", executor_listener)
+        assert [job.job_type for job in edge.bus._listeners["test_event"]] == \
+            [JobType.Callback, JobType.Coroutinefunction, JobType.Callback]
+
+        edge.bus.async_fire("test_event", 1)
+        edge.bus.async_fire("test_event", 2)
+        await asyncio.sleep(0)
+        await edge.async_block_till_done()
+        assert sorted(received) == [("callback", 1), ("callback", 2),
+                                    ("coroutine", 1), ("coroutine", 2),
+                                    ("executor", 1)]
+        assert edge.bus.async_listeners() == {"test_event": 2}
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_pending_tasks_pruned():
+    edge = new_edge()
+
+    async def job():
+        await asyncio.sleep(0)
+
+    async def run():
+        for _ in range(10):
+            edge.async_create_task(job())
+        assert edge.pending_task_count == 10
+        await edge.async_block_till_done()
+        await asyncio.sleep(0)
+        assert edge.pending_task_count == 0
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_event_lazy_time_fired_and_context():
+    event = Event("test_event", {"key": "value"})
+    assert event._context is None
+    assert event._time_fired is None
+
+    now = dt_util.utcnow()
+    assert abs((now - event.time_fired).total_seconds()) < 1
+    assert event.time_fired is event.time_fired
+    assert event.context is event.context
+
+
+def test_bus_wildcard_listeners():
+    edge = new_edge()
+    received = []
+
+    def recorder(name):
+        @callback
+        def listener(event):
+            received.append((name, event.event_type))
+        return listener
+
+    async def run():
+        edge.bus.async_listen(MATCH_ALL, recorder("all"))
+        remove_prefix = edge.bus.async_listen("rtmp_frame_*", recorder("prefix"))
+        edge.bus.async_listen("wirefire_*_output", recorder("glob"))
+        edge.bus.async_listen("rtmp_frame_1", recorder("exact"))
+
+        edge.bus.async_fire("rtmp_frame_1")
+        edge.bus.async_fire("wirefire_com_output")
+        edge.bus.async_fire("other")
+        await asyncio.sleep(0)
+        assert received == [("all", "rtmp_frame_1"),
+                            ("prefix", "rtmp_frame_1"),
+                            ("exact", "rtmp_frame_1"),
+                            ("all", "wirefire_com_output"),
+                            ("glob", "wirefire_com_output"),
+                            ("all", "other")]
+
+        received.clear()
+        remove_prefix()
+        edge.bus.async_fire("rtmp_frame_1")
+        await asyncio.sleep(0)
+        assert received == [("all", "rtmp_frame_1"),
+                            ("exact", "rtmp_frame_1")]
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_delete_wire_releases_listener():
+    edge = new_edge()
+    ServiceProviderFactory.provider_classes["virtual"] = VirtualInterfaceProvider
+    ServiceProviderFactory.edge = edge
+    virtual_template = {
+        "component": {
+            "name": "virtual_component",
+            "inputs": [{"name": "test_input", "protocol": {"name": "virtual"}}],
+            "outputs": [{"name": "test_output", "protocol": {"name": "virtual"}}]
+        }
+    }
+    output_com = Component(edge, virtual_template)
+    input_com = Component(edge, virtual_template)
+    edge.components[output_com.id] = output_com
+    edge.components[input_com.id] = input_com
+
+    async def run():
+        wires = []
+        for _ in range(2):
+            wire = await edge.connect_interface(output_com.id, "test_output",
+                                                input_com.id, "test_input")
+            wires.append(wire)
+        event_type = "virtual_wire_event_{}_test_output".format(output_com.id)
+        assert edge.bus.async_listeners() == {event_type: 1}
+
+        edge.delete_wire(wires[0].id)
+        # REST API thread, the listener is removed in the loop
+        await edge.loop.run_in_executor(None, edge.delete_wire, wires[1].id)
+        await asyncio.sleep(0)
+        assert edge.bus.async_listeners() == {}
+        assert edge._routes == {}
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_partition_nodes_by_connected_component():
+    placement = graph_util.partition_nodes(
+        ["a", "b", "c", "d", "e", "f"],
+        [("a", "b"), ("b", "c"), ("d", "e")],
+        2)
+    assert placement["a"] == placement["b"] == placement["c"]
+    assert placement["d"] == placement["e"]
+    assert placement["a"] != placement["d"]
+    assert placement["f"] == placement["d"]
+
+
+def test_wire_queue_policies():
+    async def run():
+        drop_oldest = WireQueue(2, "drop_oldest")
+        drop_newest = WireQueue(2, "drop_newest")
+        latest_only = WireQueue(3, "latest_only")
+        for i in range(4):
+            await drop_oldest.put(i)
+            await drop_newest.put(i)
+            await latest_only.put(i)
+        assert [drop_oldest.get_nowait() for _ in range(2)] == [2, 3]
+        assert [drop_newest.get_nowait() for _ in range(2)] == [0, 1]
+        assert latest_only.get_nowait() == 3
+        assert drop_oldest.stats()["dropped"] == 2
+        assert latest_only.stats() == {"depth": 0, "size": 1,
+                                       "policy": "latest_only", "dropped": 3}
+
+        block = WireQueue(1, "block")
+        await block.put(0)
+        put = asyncio.ensure_future(block.put(1))
+        await asyncio.sleep(0)
+        assert not put.done()
+        assert block.get_nowait() == 0
+        await put
+        assert block.dropped == 0
+
+        # Resized in place, the blocked producer gets the new slot
+        put = asyncio.ensure_future(block.put(2))
+        await asyncio.sleep(0)
+        assert not put.done()
+        block.configure(2, "block")
+        await put
+        assert block.qsize() == 2
+        block.configure(3, "latest_only")
+        assert block.get_nowait() == 2 and block.dropped == 1
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+class CollectWireLoad(WireLoad):
+    name = "collect_wireload"
+
+    def __init__(self, edge, model_template_config, component_id=None, init_params=None):
+        super(CollectWireLoad, self).__init__(edge, model_template_config, component_id, init_params)
+        self.processed = []
+
+    async def process(self, input_payload):
+        self.processed.append(input_payload)
+
+
+class ShardSourceWireLoad(WireLoad):
+    name = "shard_source"
+
+    async def process(self, input_payload):
+        pass
+
+
+class ShardSinkWireLoad(WireLoad):
+    name = "shard_sink"
+
+    def __init__(self, edge, model_template_config, component_id=None, init_params=None):
+        super(ShardSinkWireLoad, self).__init__(edge, model_template_config, component_id, init_params)
+        self.received = []  # (payload, thread name)
+
+    async def process(self, input_payload):
+        self.received.append((input_payload, threading.current_thread().name))
+
+
+SHARD_FORMULA = """
+formula: shard_test_formula
+components:
+  - template: shard_source
+    id: source_a
+  - template: shard_sink
+    id: sink_a
+  - template: shard_source
+    id: source_b
+  - template: shard_sink
+    id: sink_b
+wires:
+  - output_sink: {component_id: source_a, output: output}
+    input_slot: {component_id: sink_a, input: input}
+  - output_sink: {component_id: source_b, output: output}
+    input_slot: {component_id: sink_b, input: input}
+"""
+
+
+def test_shard_formula(tmp_path):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    edge = MerceEdge({"wireload": {"paths": []}, "shard": {"workers": 2}})
+    ServiceProviderFactory.provider_classes["virtual"] = VirtualInterfaceProvider
+    for wireload_class in (ShardSourceWireLoad, ShardSinkWireLoad):
+        edge.wireload_factory._classes[wireload_class.name] = wireload_class
+        edge.component_templates[wireload_class.name] = {
+            "component": {
+                "name": wireload_class.name,
+                "virtual": True,
+                "inputs": [{"name": "input", "protocol": {"name": "virtual"}}],
+                "outputs": [{"name": "output", "protocol": {"name": "virtual"}}]
+            }
+        }
+    formula_path = tmp_path / "shard_test_formula.yaml"
+    formula_path.write_text(SHARD_FORMULA)
+
+    async def emit(source, payload):
+        await asyncio.wrap_future(run_coroutine_threadsafe(
+            source.put_output_payload("output", payload), source.edge.loop))
+
+    async def wait_received(sink, count):
+        for _ in range(100):
+            if len(sink.received) >= count:
+                return
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await edge.load_formula(str(formula_path))
+        shards = list(edge.shards)
+        assert len(shards) == 2
+        components = edge.components
+        source_a, sink_a = components["source_a"], components["sink_a"]
+        source_b, sink_b = components["source_b"], components["sink_b"]
+        # Pipelines are placed whole, one per shard
+        assert source_a.edge is sink_a.edge and source_b.edge is sink_b.edge
+        assert {source_a.edge, source_b.edge} == set(shards)
+
+        await emit(source_a, "a")
+        await emit(source_b, "b")
+        await wait_received(sink_a, 1)
+        await wait_received(sink_b, 1)
+        assert sink_a.received == [("a", source_a.edge._thread.name)]
+        assert sink_b.received == [("b", source_b.edge._thread.name)]
+
+        # Wire across shards, delivered through the cross-shard channel
+        await edge.connect_interface("source_a", "output", "sink_b", "input")
+        await emit(source_a, "ab")
+        await wait_received(sink_b, 2)
+        assert sink_b.received[1] == ("ab", source_b.edge._thread.name)
+
+        await edge.async_stop()
+        return shards
+
+    shards = edge.loop.run_until_complete(run())
+    for shard in shards:
+        assert not shard._thread.is_alive()
+    assert edge.shards == []
+    edge.loop.close()
+
+
+def test_wireload_fixed_workers():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    wireload = CollectWireLoad(edge, component_template)
+
+    async def run():
+        wire = Wire(edge, output_com.outputs["test_output"],
+                    wireload.inputs["test_input"])
+        wire.connect()
+        wire.connect()
+        await asyncio.sleep(0)
+        assert len(wireload._workers) == 1
+        tasks = len(asyncio.all_tasks())
+
+        for i in range(20):
+            await wireload.put_input_payload(i)
+        await asyncio.sleep(0.01)
+        assert wireload.processed == list(range(20))
+        assert len(asyncio.all_tasks()) == tasks
+
+        worker = wireload._workers[0]
+        edge.components[wireload.id] = wireload
+        edge.stop_wireload_exec()
+        await asyncio.sleep(0)
+        assert worker.cancelled()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_wireload_buffer_after_workers_started():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    wireload = CollectWireLoad(edge, component_template)
+
+    async def run():
+        Wire(edge, output_com.outputs["test_output"],
+             wireload.inputs["test_input"]).connect()
+        await asyncio.sleep(0)
+        queue = wireload.input_q
+
+        wire = Wire(edge, output_com.outputs["test_output"],
+                    wireload.inputs["test_input"])
+        wire.set_buffer(5, "latest_only")
+        wire.connect()
+        assert wireload.input_q is queue
+        assert queue.stats()["policy"] == "latest_only"
+
+        await wireload.put_input_payload(1)
+        await asyncio.sleep(0)
+        assert wireload.processed == [1]
+        assert queue.qsize() == 0
+
+        # The shared queue keeps the first declared buffer
+        other = Wire(edge, output_com.outputs["test_output"],
+                     wireload.inputs["test_input"])
+        other.set_buffer(2, "drop_newest")
+        assert queue.policy == "latest_only"
+        assert (other.buffer_size, other.buffer_policy) == (1, "latest_only")
+        wireload.stop()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+two_outputs_template = {
+    "component": {
+        "name": "two_outputs_component",
+        "inputs": [{"name": "test_input", "protocol": {"name": "test"}}],
+        "outputs": [{"name": "a", "protocol": {"name": "test"}},
+                    {"name": "b", "protocol": {"name": "test"}}]
+    }
+}
+
+
+class TwoOutputsWireLoad(WireLoad):
+    name = "two_outputs_wireload"
+
+    async def process(self, input_payload):
+        await self.put_output_payload("a", input_payload)
+        await self.put_output_payload("b", input_payload)
+
+
+def test_wire_buffer_keeps_upstream_outputs():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    wireload = TwoOutputsWireLoad(edge, two_outputs_template)
+    downstream = CollectWireLoad(edge, component_template)
+    received = []
+
+    @callback
+    def listener(event):
+        received.append(event.event_type.rsplit("_", 1)[-1])
+
+    async def run():
+        for output_name in ("a", "b"):
+            edge.bus.async_listen(
+                "virtual_wire_event_{}_{}".format(wireload.id, output_name), listener)
+        Wire(edge, output_com.outputs["test_output"],
+             wireload.inputs["test_input"]).connect()
+        wire = Wire(edge, wireload.outputs["a"], downstream.inputs["test_input"])
+        wire.set_buffer(1, "latest_only")
+        wire.connect()
+        assert downstream.input_q.policy == "latest_only"
+        assert wireload.output_q.policy != "latest_only"
+
+        await wireload.put_input_payload(1)
+        for _ in range(3):
+            await asyncio.sleep(0)
+            await edge.async_block_till_done()
+        assert received == ["a", "b"]
+        wireload.stop()
+        downstream.stop()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+class BatchWireLoad(CollectWireLoad):
+    name = "batch_wireload"
+
+    async def process_batch(self, input_payloads):
+        self.processed.append(list(input_payloads))
+
+
+def test_wireload_process_batch():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    wireload = BatchWireLoad(edge, component_template,
+                             init_params={"max_batch": 4, "max_wait_ms": 20})
+    wireload.set_input_buffer(10, "block")
+
+    async def run():
+        Wire(edge, output_com.outputs["test_output"],
+             wireload.inputs["test_input"]).connect()
+        for i in range(10):
+            await wireload.put_input_payload(i)
+        await asyncio.sleep(0.1)
+        assert wireload.processed == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+        await wireload.put_input_payload(10)
+        await asyncio.sleep(0.1)
+        assert wireload.processed[-1] == 10
+        wireload.stop()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_shared_array_channel():
+    writer, reader = SharedArrayChannel(), SharedArrayChannel()
+    assert writer.encode({"value": 1}) == (None, {"value": 1})
+
+    array = np.arange(SHARED_ARRAY_MIN_BYTES, dtype=np.uint8)
+    name, payload = writer.encode({"frames": [array], "value": 1})
+    assert name is not None and payload["value"] == 1
+    decoded = reader.decode(name, payload)
+    assert (decoded["frames"][0] == array).all()
+
+    # A larger message grows the segment, the reader attaches the new one
+    large = np.ones(2 * SHARED_ARRAY_MIN_BYTES, dtype=np.uint8)
+    grown, payload = writer.encode((array, large))
+    assert grown != name
+    first, second = reader.decode(grown, payload)
+    assert (first == array).all() and (second == large).all()
+    reader.close_reader()
+    writer.close_writer()
+
+
+def _double_handler_setup():
+    def handle(payload):
+        if payload is None:
+            raise ValueError("no payload")
+        return payload * 2
+    return handle
+
+
+def test_process_worker():
+    worker = ProcessWorker(_double_handler_setup, name="TestWorker")
+    array = np.ones(SHARED_ARRAY_MIN_BYTES, dtype=np.uint8)
+    assert (worker.call(array) == 2).all()
+    assert worker.call(3) == 6
+    with pytest.raises(ProcessWorkerError) as error:
+        worker.call(None)
+    assert "no payload" in error.value.worker_traceback
+    # The worker survives a handler error
+    assert worker.call(4) == 8
+
+    process = worker._process
+    worker.stop()
+    assert worker._process is None and not process.is_alive()
+    worker.stop()
+
+
+def test_process_worker_respawn():
+    worker = ProcessWorker(_double_handler_setup, name="TestWorker")
+    assert worker.call(1) == 2
+    process = worker._process
+    os.kill(process.pid, signal.SIGKILL)
+    process.join(5)
+    with pytest.raises(ProcessWorkerError) as error:
+        worker.call(2)
+    assert "exited" in error.value.worker_traceback
+    assert worker._process is None
+    # The next call starts a new worker process
+    assert worker.call(3) == 6
+    assert worker._process.pid != process.pid
+    worker.stop()
+
+
+class DoubleWireLoad(WireLoad):
+    name = "double_wireload"
+
+    async def process(self, input_payload):
+        await self.put_output_payload("test_output", input_payload * 2)
+
+
+def test_wireload_process_execution():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    wireload = DoubleWireLoad(edge, component_template,
+                              init_params={"execution": "process"})
+    received = []
+
+    @callback
+    def listener(event):
+        received.append(event.data)
+
+    async def run():
+        edge.bus.async_listen(
+            "virtual_wire_event_{}_test_output".format(wireload.id), listener)
+        Wire(edge, output_com.outputs["test_output"],
+             wireload.inputs["test_input"]).connect()
+        for i in range(3):
+            await wireload.put_input_payload(i)
+        for _ in range(100):
+            if len(received) == 3:
+                break
+            await asyncio.sleep(0.05)
+        assert received == [0, 2, 4]
+        process = wireload._process_worker._process
+        assert process.pid != os.getpid()
+        wireload.stop()
+        assert not process.is_alive()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+class ExecutorWireLoad(WireLoad):
+    name = "executor_wireload"
+
+    async def _cube(self, value):
+        return value ** 3
+
+    async def process(self, input_payload):
+        square = await self.edge.async_add_executor_job(pow, input_payload, 2)
+        cube = await self.edge.async_create_task(self._cube(input_payload))
+        pid = await self.edge.async_add_job(os.getpid)
+        await self.put_output_payload("test_output", (square, cube, pid))
+
+
+def test_wireload_process_execution_jobs():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    wireload = ExecutorWireLoad(edge, component_template,
+                                init_params={"execution": "process"})
+    received = []
+
+    @callback
+    def listener(event):
+        received.append(event.data)
+
+    async def run():
+        edge.bus.async_listen(
+            "virtual_wire_event_{}_test_output".format(wireload.id), listener)
+        Wire(edge, output_com.outputs["test_output"],
+             wireload.inputs["test_input"]).connect()
+        await wireload.put_input_payload(3)
+        for _ in range(100):
+            if received:
+                break
+            await asyncio.sleep(0.05)
+        assert received == [(9, 27, wireload._process_worker._process.pid)]
+        wireload.stop()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+class EncodeWireLoad(WireLoad):
+    name = "encode_wireload"
+
+    async def process(self, input_payload):
+        # Like the object detection wireload, encode off the worker loop
+        frame_bytes = await self.edge.async_add_executor_job(
+            encode_frame, input_payload, 'raw', 0, 7)
+        await self.put_output_payload("test_output", frame_bytes)
+
+
+def test_wireload_process_execution_encode_frame():
+    edge = new_edge()
+    output_com = Component(edge, component_template)
+    wireload = EncodeWireLoad(edge, component_template,
+                              init_params={"execution": "process"})
+    frame = np.arange(4 * 6 * 3, dtype=np.uint8).reshape(4, 6, 3)
+    received = []
+
+    @callback
+    def listener(event):
+        received.append(event.data)
+
+    async def run():
+        edge.bus.async_listen(
+            "virtual_wire_event_{}_test_output".format(wireload.id), listener)
+        Wire(edge, output_com.outputs["test_output"],
+             wireload.inputs["test_input"]).connect()
+        await wireload.put_input_payload(frame)
+        for _ in range(100):
+            if received:
+                break
+            await asyncio.sleep(0.05)
+        header, decoded = decode_frame(received[0])
+        assert header.seq == 7
+        assert np.array_equal(decoded, frame)
+        wireload.stop()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_metrics_shared_by_threads():
+    metrics = metrics_util.Metrics(enabled=True)
+
+    def record():
+        for _ in range(10000):
+            metrics.counter("payloads", "wire").inc()
+            metrics.histogram("seconds", "wire").observe(0.001)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.get_counter("payloads", "wire") == 40000
+    histogram = metrics.get_histogram("seconds", "wire")
+    assert histogram["count"] == 40000
+    assert histogram["sum"] == pytest.approx(40.0)
+
+
+def test_metrics():
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    edge = MerceEdge({"wireload": {"paths": []}, "metrics": {"enabled": True}})
+    output_com = Component(edge, component_template)
+    wireload = CollectWireLoad(edge, component_template)
+
+    @callback
+    def listener(event):
+        pass
+
+    async def run():
+        edge.bus.async_listen("test_event", listener)
+        for _ in range(3):
+            edge.bus.async_fire("test_event")
+        edge.bus.async_fire("no_listener_event")
+        await asyncio.sleep(0)
+
+        wire = Wire(edge, output_com.outputs["test_output"],
+                    wireload.inputs["test_input"])
+        wire.connect()
+
+        async def emit_input_slot(input, payload):
+            await input.component.put_input_payload(payload)
+        provider = type("Provider", (), {"emit_input_slot": staticmethod(emit_input_slot),
+                                         "queues_payload_objects": True})
+        # Another input of the same protocol is not counted on the wire
+        other = CollectWireLoad(edge, component_template)
+        for input_slot in (wireload.inputs["test_input"], other.inputs["test_input"]):
+            input_slot.provider = provider
+            await input_slot.emit_data_to_input(MockEvent(1))
+        await asyncio.sleep(0.01)
+        wireload.stop()
+
+        metrics = edge.metrics.as_dict()
+        assert metrics["bus_events_fired"] == {"test_event": 3,
+                                               "no_listener_event": 1}
+        assert metrics["bus_listener_seconds"]["test_event"]["count"] == 3
+        stats = wire.stats()
+        assert stats["input_wireload"]["input"]["depth"] == 0
+        assert stats["input_wireload"]["process_seconds"]["count"] == 1
+        assert stats["input_payloads"] == 1
+        assert stats["provider_emit_seconds"]["count"] == 1
+        assert metrics["wireload_input_payloads"] == {wireload.id: 1, other.id: 1}
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_wire_trace_sampling():
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    edge = MerceEdge({"wireload": {"paths": []}, "trace": {"sample_every": 2}})
+    output_com = Component(edge, component_template)
+    wireload = CollectWireLoad(edge, component_template)
+    output_sink = output_com.outputs["test_output"]
+
+    async def run():
+        wire = Wire(edge, output_sink, wireload.inputs["test_input"])
+        wire.connect()
+
+        async def emit_input_slot(input, payload):
+            await wireload.put_input_payload(payload)
+        wireload.inputs["test_input"].provider = type(
+            "Provider", (), {"emit_input_slot": staticmethod(emit_input_slot),
+                             "queues_payload_objects": True})
+        edge.bus.async_listen("test_output_event", output_sink.output_sink_callback)
+        for i in range(4):
+            edge.bus.async_fire("test_output_event", i)
+        await asyncio.sleep(0.01)
+
+        assert wireload.processed == [0, 1, 2, 3]
+        trace = wire.stats()["trace"]
+        assert trace["total"]["count"] == 2
+        assert set(trace) == {"bus_dispatch", "output_sink", "input_emit",
+                              "wireload_dequeue", "process_done", "total"}
+
+        # Messages entering through fire() are sampled once
+        for i in range(8):
+            edge.bus.fire("test_output_event", i)
+        await asyncio.sleep(0.01)
+        assert wire.stats()["trace"]["total"]["count"] == 6
+        wireload.stop()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_memory_provider():
+    edge = new_edge()
+    ServiceProviderFactory.provider_classes["memory"] = MemoryInterfaceProvider
+    ServiceProviderFactory.edge = edge
+    memory_template = {
+        "component": {
+            "name": "memory_component",
+            "inputs": [{"name": "test_input", "protocol": {"name": "memory"}}],
+            "outputs": [{"name": "test_output", "protocol": {"name": "memory"}}]
+        }
+    }
+    output_com = Component(edge, memory_template)
+    input_com = Component(edge, memory_template)
+    edge.components[output_com.id] = output_com
+    edge.components[input_com.id] = input_com
+
+    async def run():
+        wire = await edge.connect_interface(output_com.id, "test_output",
+                                            input_com.id, "test_input",
+                                            output_params={"channel": "sensor"})
+        received = ([], [])
+        subscribers = [
+            MemoryInterfaceProvider.subscribe(
+                "{}_test_input".format(input_com.id), received[0].append),
+            MemoryInterfaceProvider.subscribe(
+                "{}_test_input".format(input_com.id), received[1].append)]
+
+        payload = {"value": 1}
+        await MemoryInterfaceProvider.publish("sensor", payload)
+        await edge.async_block_till_done()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert received[0] == received[1] == [payload]
+        assert received[0][0] is payload
+        assert "sensor" in MemoryInterfaceProvider.channels(edge.loop)
+        other_loop = asyncio.new_event_loop()
+        assert MemoryInterfaceProvider.channels(other_loop) == {}
+        other_loop.close()
+
+        edge.delete_wire(wire.id)
+        for subscriber in subscribers:
+            subscriber.unsubscribe()
+        assert edge.bus.async_listeners() == {}
+        # Channels leave with their last subscriber
+        assert MemoryInterfaceProvider.channels() == {}
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+class MockMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def test_mqtt_connection_pool():
+    edge = new_edge()
+    config = {"mqtt": {"broker": "localhost"}}
+
+    async def run():
+        providers = [MqttServiceProvider(edge, config) for _ in range(3)]
+        connection = providers[0].get_connection({})
+        assert providers[0].get_connection({}) is connection
+        assert providers[1].get_connection({"port": "1883"}) is connection
+        other = providers[2].get_connection({"client_id": "other"})
+        assert other is not connection
+        assert MqttServiceProvider.connections.count(connection.key) == 2
+
+        fired = []
+
+        @callback
+        def listener(event):
+            fired.append(event)
+
+        edge.bus.async_listen("mqtt_msg_rcv_*", listener)
+        assert connection._add_subscription("sensor/1", 0, "mqtt_msg_rcv_a")
+        assert not connection._add_subscription("sensor/1", 0, "mqtt_msg_rcv_b")
+        assert connection._add_subscription("sensor/2", 0, "mqtt_msg_rcv_c")
+        assert connection._add_subscription("sensor/+", 0, "mqtt_msg_rcv_d")
+        connection._mqtt_on_message(None, None, MockMessage("sensor/1", b"on"))
+        connection._mqtt_on_message(None, None, MockMessage("light/1", b"off"))
+        await asyncio.sleep(0)
+        await edge.async_block_till_done()
+        assert sorted(event.event_type for event in fired) == \
+            ["mqtt_msg_rcv_a", "mqtt_msg_rcv_b", "mqtt_msg_rcv_d"]
+        assert fired[0].data == "on"
+        assert not connection._remove_subscription("sensor/1", "mqtt_msg_rcv_a")
+        assert connection._remove_subscription("sensor/1", "mqtt_msg_rcv_b")
+
+        providers[0]._release_connection()
+        assert connection.key in MqttServiceProvider.connections
+        # REST API thread, the connection is closed in the loop
+        await edge.loop.run_in_executor(None, providers[1]._release_connection)
+        assert connection.key not in MqttServiceProvider.connections
+        await asyncio.sleep(0)
+        assert connection._stopped
+
+        edge.bus.async_fire(EVENT_EDGE_STOP)
+        await edge.async_block_till_done()
+        assert other.key not in MqttServiceProvider.connections
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_topic_trie():
+    trie = TopicTrie()
+    assert trie.add("home/+/temperature", "a")
+    assert trie.add("home/#", "b")
+    assert trie.add("home/kitchen/temperature", "c")
+    assert not trie.add("home/kitchen/temperature", "d")
+    assert trie.add("#", "e")
+    assert len(trie) == 4
+
+    assert sorted(trie.match("home/kitchen/temperature")) == ["a", "b", "c", "d", "e"]
+    assert sorted(trie.match("home")) == ["b", "e"]
+    assert sorted(trie.match("home/garage/temperature")) == ["a", "b", "e"]
+    assert trie.match("$SYS/home") == []
+
+    assert not trie.remove("home/kitchen/temperature", "c")
+    assert trie.remove("home/kitchen/temperature", "d")
+    assert not trie.remove("home/kitchen/temperature", "d")
+    assert trie.remove("#", "e")
+    assert sorted(trie.match("home/kitchen/temperature")) == ["a", "b"]
+    assert trie.subscribers("home/#") == {"b": None}
+    assert len(trie) == 2
+
+    for topic_filter in ("home/#/temperature", "home/kitchen+", "", None):
+        with pytest.raises(InvalidTopicFilter):
+            trie.add(topic_filter, "f")
+
+
+def test_frame_ring():
+    ring = FrameRing((2, 3), slots=2)
+    frames = []
+    for value in range(3):
+        ring.write_slot()[...] = value
+        frames.append(ring.commit())
+    assert [frame.seq for frame in frames] == [0, 1, 2]
+    assert not frames[0].valid()
+    assert frames[2].valid() and frames[2].frame[0, 0] == 2
+    assert not frames[2].frame.flags.writeable
+
+    attached = pickle.loads(pickle.dumps(frames[1]))
+    assert attached.ring is ring
+    assert attached.seq == 1 and attached.valid()
+    assert attached.frame.tolist() == [[1, 1, 1], [1, 1, 1]]
+
+    copy = frames[2].copy()
+    assert copy.tolist() == [[2, 2, 2], [2, 2, 2]]
+    assert frames[0].copy() is None
+    # Invalid as soon as the decoder writes the slot, before commit()
+    ring.write_slot()
+    assert not frames[1].valid() and frames[1].copy() is None
+    ring.close()
+
+
+def test_frame_codec_raw():
+    ring = FrameRing((2, 3, 3), slots=1)
+    ring.write_slot()[...] = 7
+    data = encode_frame(ring.commit().frame, 'raw', seq=5, timestamp=1.5)
+    assert len(data) == HEADER_SIZE + 18
+
+    header, frame = decode_frame(data)
+    assert header.codec == 'raw' and header.shape == (2, 3, 3)
+    assert (header.height, header.width) == (2, 3)
+    assert header.seq == 5 and header.timestamp == 1.5
+    assert frame.tolist() == [[[7] * 3] * 3] * 2
+    ring.close()
+
+    with pytest.raises(InvalidFrame):
+        decode_frame(data[:HEADER_SIZE + 1])
+    with pytest.raises(InvalidFrame):
+        decode_frame(b'x' * HEADER_SIZE)
+
+
+def test_frame_pacer():
+    pacer = FramePacer(fps=10)
+    first = pacer.due()
+    assert pacer.due() == pytest.approx(first + 0.1)
+    assert pacer.due() == pytest.approx(first + 0.2)
+    # A decoder falling behind does not burst to catch up
+    pacer._due -= 1
+    assert pacer.due() == pytest.approx(monotonic(), abs=0.05)
+
+    pacer = FramePacer(use_timestamps=True)
+    start = pacer.due(0)
+    assert pacer.due(500) == pytest.approx(start + 0.5)
+    assert FramePacer().due(500) == pytest.approx(monotonic(), abs=0.05)
+
+
+class MockInterface:
+    def __init__(self, component=None, attrs=None):
+        self.id = "output"
+        self.component = component
+        self.attrs = attrs or {}
+        self.output_wires = {}
+
+    def get_attrs(self, key):
+        return self.attrs.get(key)
+
+
+def test_rtmp_latest_frame_waits_for_consumer():
+    edge = new_edge()
+    wireload = CollectWireLoad(edge, component_template)
+    output = MockInterface(attrs={"rtmp_url": "rtmp://camera", "latest_frame": True})
+    output.output_wires["wire"] = type("MockWire", (), {
+        "input_slot": MockInterface(component=wireload)})
+    stream = RTMPStream(edge, output, "rtmp_frame_output")
+    delivered = []
+
+    @callback
+    def listener(event):
+        delivered.append(event.data)
+
+    async def run():
+        edge.bus.async_listen("rtmp_frame_output", listener)
+        stream._deliver(1)
+        stream._deliver(2)
+        await asyncio.sleep(0.02)
+        assert delivered == [] and stream.stats["replaced"] == 1
+
+        consumer = asyncio.ensure_future(wireload.input_q.get())
+        await asyncio.sleep(0.02)
+        assert delivered == [2]
+        consumer.cancel()
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+def test_rtmp_stop_listener_once_per_provider():
+    edge = new_edge()
+    provider = RTMPProvider(edge, {})
+    output = MockInterface()
+    output.output_wires["wire"] = None
+
+    async def run():
+        for _ in range(3):
+            await provider.async_setup(edge, {})
+        assert edge.bus.async_listeners()[EVENT_EDGE_STOP] == 1
+
+        # Released with the last stream
+        provider.disconn_output_sink(output)
+        await asyncio.sleep(0)
+        assert EVENT_EDGE_STOP not in edge.bus.async_listeners()
+
+        await provider.async_setup(edge, {})
+        edge.bus.async_fire(EVENT_EDGE_STOP)
+        await edge.async_block_till_done()
+        assert EVENT_EDGE_STOP not in edge.bus.async_listeners()
+        assert provider._listeners == {}
+
+    edge.loop.run_until_complete(run())
+    edge.loop.close()
+
+
+class FakeStream:
+    """Stream of frames frames, one due every interval seconds."""
+    def __init__(self, name, frames, interval, decoded):
+        self.url = name
+        self.frames = frames
+        self.interval = interval
+        self.decoded = decoded
+        self.stopped = False
+        self.closed = threading.Event()
+        self.stats = {}
+
+    def step(self):
+        if not self.frames:
+            return None
+        self.frames -= 1
+        self.decoded.append(self.url)
+        return monotonic() + self.interval
+
+    def close(self):
+        self.closed.set()
+
+
+def test_decode_pool_schedule():
+    decoded = []
+    pool = DecodePool(workers=1)
+    fast = FakeStream("fast", 4, 0.02, decoded)
+    slow = FakeStream("slow", 2, 0.05, decoded)
+    pool.add(fast)
+    pool.add(slow)
+    assert fast.closed.wait(1) and slow.closed.wait(1)
+    # Streams run earliest due first on one thread
+    assert decoded == ["fast", "slow", "fast", "fast", "slow", "fast"]
+    assert len(pool._threads) == 1
+
+    endless = FakeStream("endless", 1000, 0.01, decoded)
+    pool.add(endless)
+    pool.stop()
+    assert endless.closed.wait(1)
+    pool._threads[0].join(1)
+    assert not pool._threads[0].is_alive()
+
+
+def test_refcounted_registry():
+    registry = RefCountedRegistry()
+    created, closed = [], []
+
+    def factory():
+        created.append(object())
+        return created[-1]
+
+    first = registry.acquire("model", factory)
+    assert registry.acquire("model", factory) is first
+    assert len(created) == 1 and registry.count("model") == 2
+
+    assert not registry.release("model", closed.append)
+    assert registry.release("model", closed.append)
+    assert closed == [first] and "model" not in registry
+    assert not registry.release("model", closed.append)
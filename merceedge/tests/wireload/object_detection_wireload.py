@@ -12,6 +12,9 @@ from threading import Thread
 from merceedge.tests.detect_object.utils.app_utils import FPS, WebcamVideoStream, draw_boxes_and_labels
 from merceedge.tests.detect_object.object_detection.utils import label_map_util
 from merceedge.core import WireLoad
+from merceedge.util.refcount import RefCountedRegistry
+from merceedge.util.frame_ring import RingFrame
+from merceedge.util.frame_codec import encode_frame, DEFAULT_CODEC, DEFAULT_QUALITY
 
 
 CWD_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -28,43 +31,205 @@ PATH_TO_LABELS = os.path.join(CWD_PATH, '..', 'detect_object',
 
 NUM_CLASSES = 90
 
-# Loading label map
-label_map = label_map_util.load_labelmap(PATH_TO_LABELS)
-categories = label_map_util.convert_label_map_to_categories(label_map, max_num_classes=NUM_CLASSES,
-                                                            use_display_name=True)
-category_index = label_map_util.create_category_index(categories)
+_category_index = None
 
 
-def detect_objects(image_np, sess, detection_graph, min_score_thresh=0.5):
-    # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-    image_np_expanded = np.expand_dims(image_np, axis=0)
-    image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
+def get_category_index():
+    """Load the label map on first use."""
+    global _category_index
+    if _category_index is None:
+        label_map = label_map_util.load_labelmap(PATH_TO_LABELS)
+        categories = label_map_util.convert_label_map_to_categories(label_map, max_num_classes=NUM_CLASSES,
+                                                                    use_display_name=True)
+        _category_index = label_map_util.create_category_index(categories)
+    return _category_index
 
-    # Each box represents a part of the image where a particular object was detected.
-    boxes = detection_graph.get_tensor_by_name('detection_boxes:0')
 
-    # Each score represent how level of confidence for each of the objects.
-    # Score is shown on the result image, together with the class label.
-    scores = detection_graph.get_tensor_by_name('detection_scores:0')
-    classes = detection_graph.get_tensor_by_name('detection_classes:0')
-    num_detections = detection_graph.get_tensor_by_name('num_detections:0')
+# Inference engine batching defaults, see ObjectDetectionWireLoad parameters
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_BATCH_TIMEOUT_MS = 20
 
-    # Actual detection.
-    (boxes, scores, classes, num_detections) = sess.run(
-        [boxes, scores, classes, num_detections],
-        feed_dict={image_tensor: image_np_expanded})
 
+def build_detection_result(boxes, classes, scores, min_score_thresh=0.5):
     # Visualization of the results of a detection.
     rect_points, class_names, class_colors = draw_boxes_and_labels(
-        boxes=np.squeeze(boxes),
-        classes=np.squeeze(classes).astype(np.int32),
-        scores=np.squeeze(scores),
-        category_index=category_index,
+        boxes=boxes,
+        classes=classes.astype(np.int32),
+        scores=scores,
+        category_index=get_category_index(),
         min_score_thresh=min_score_thresh
     )
     return dict(rect_points=rect_points, class_names=class_names, class_colors=class_colors)
 
 
+class DetectionModel(object):
+    """Frozen detection graph and its session.
+
+    Models are shared process wide through ``DetectionModel.registry``, keyed
+    by model path and session config, loaded by the first user and closed
+    when the last one releases it.
+    """
+    registry = RefCountedRegistry()
+
+    def __init__(self, model_path, session_config=None):
+        self.detection_graph = tf.Graph()
+        with self.detection_graph.as_default():
+            od_graph_def = tf.GraphDef()
+            with tf.gfile.GFile(model_path, 'rb') as fid:
+                serialized_graph = fid.read()
+                od_graph_def.ParseFromString(serialized_graph)
+                tf.import_graph_def(od_graph_def, name='')
+
+            config = tf.ConfigProto(**session_config) if session_config else None
+            self.sess = tf.Session(graph=self.detection_graph, config=config)
+
+        self.image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
+        # Each box represents a part of the image where a particular object was detected.
+        # Each score represent how level of confidence for each of the objects.
+        # Score is shown on the result image, together with the class label.
+        self.output_tensors = [self.detection_graph.get_tensor_by_name(name)
+                               for name in ('detection_boxes:0', 'detection_classes:0',
+                                            'detection_scores:0')]
+
+    @staticmethod
+    def registry_key(model_path, session_config=None):
+        # A forked process does not reuse the session of its parent
+        return (os.getpid(), model_path, tuple(sorted((session_config or {}).items())))
+
+    @classmethod
+    def acquire(cls, model_path, session_config=None):
+        return cls.registry.acquire(cls.registry_key(model_path, session_config),
+                                    lambda: cls(model_path, session_config))
+
+    @classmethod
+    def release(cls, model_path, session_config=None):
+        cls.registry.release(cls.registry_key(model_path, session_config),
+                             lambda model: model.sess.close())
+
+    def run(self, images):
+        """Run the model on a batch of images, return (boxes, classes,
+        scores) per image.
+        """
+        # Actual detection.
+        boxes, classes, scores = self.sess.run(
+            self.output_tensors,
+            feed_dict={self.image_tensor: images})
+        return list(zip(boxes, classes, scores))
+
+
+class InferenceEngine(object):
+    """Detection model shared by the ObjectDetectionWireLoad instances using
+    the same model. Frames of all instances are run as one batch, up to
+    batch_size frames or batch_timeout_ms after the first one.
+
+    Color conversion and inference run on a dedicated worker thread fed by a
+    queue of batches, the event loop only awaits the results.
+    """
+    # key: (model path, session config, edge), an engine resolves futures
+    # on its edge loop. The first user sets the batching parameters.
+    engines = RefCountedRegistry()
+
+    def __init__(self, edge, model_path, session_config=None,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 batch_timeout_ms=DEFAULT_BATCH_TIMEOUT_MS):
+        self.edge = edge
+        self.model_path = model_path
+        self.session_config = session_config
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout_ms / 1000
+        self._pending = []  # (image, future)
+        self._timer = None
+        self._batches = Queue()
+        self.model = None
+        self._thread = Thread(target=self._run, name='InferenceEngine', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def engine_key(cls, edge, model_path, session_config=None):
+        return DetectionModel.registry_key(model_path, session_config) + (edge, )
+
+    @classmethod
+    def acquire(cls, edge, model_path, session_config=None,
+                batch_size=DEFAULT_BATCH_SIZE,
+                batch_timeout_ms=DEFAULT_BATCH_TIMEOUT_MS):
+        return cls.engines.acquire(
+            cls.engine_key(edge, model_path, session_config),
+            lambda: cls(edge, model_path, session_config, batch_size, batch_timeout_ms))
+
+    @classmethod
+    def release(cls, edge, model_path, session_config=None):
+        cls.engines.release(cls.engine_key(edge, model_path, session_config),
+                            lambda engine: engine.stop())
+
+    async def detect(self, image_np):
+        """Return (boxes, classes, scores) of the BGR image.
+
+        Must be run in the event loop.
+        """
+        future = self.edge.loop.create_future()
+        self._pending.append((image_np, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self.edge.loop.call_later(self.batch_timeout, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        # Only images of the same shape can be stacked
+        batches = {}
+        for image_np, future in batch:
+            batches.setdefault(image_np.shape, []).append((image_np, future))
+        for batch in batches.values():
+            self._batches.put(batch)
+
+    def _run(self):
+        """Worker thread: load the model off the event loop, then run the
+        queued batches until stop().
+        """
+        try:
+            self.model = DetectionModel.acquire(self.model_path, self.session_config)
+        except Exception as e:  # pylint: disable=broad-except
+            load_error = e
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                break
+            if self.model is None:
+                self.edge.loop.call_soon_threadsafe(self._set_batch_exception, batch, load_error)
+                continue
+            try:
+                images = np.stack([cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB)
+                                   for image_np, _ in batch])
+                results = self.model.run(images)
+            except Exception as e:  # pylint: disable=broad-except
+                self.edge.loop.call_soon_threadsafe(self._set_batch_exception, batch, e)
+                continue
+            self.edge.loop.call_soon_threadsafe(self._set_batch_results, batch, results)
+        if self.model is not None:
+            DetectionModel.release(self.model_path, self.session_config)
+
+    @staticmethod
+    def _set_batch_results(batch, results):
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _set_batch_exception(batch, exception):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exception)
+
+    def stop(self):
+        """Stop the worker thread once the queued batches are done, then
+        release the model.
+        """
+        self._batches.put(None)
+
 
 class ObjectDetectionWireLoad(WireLoad):
     name = 'object_detection'
@@ -76,35 +241,87 @@ class ObjectDetectionWireLoad(WireLoad):
         self.width = 0
         self.height = 0
         self.min_score_thresh = init_params.get('min_score_thresh', 0.5)
+        self.batch_size = int(init_params.get('batch_size', DEFAULT_BATCH_SIZE))
+        self.batch_timeout_ms = float(init_params.get('batch_timeout_ms', DEFAULT_BATCH_TIMEOUT_MS))
+        # tf.ConfigProto options, eg. intra_op_parallelism_threads
+        self.session_config = init_params.get('session_config') or {}
+        # rtmp_bytes frame encoding: jpeg, png or raw, see merceedge.util.frame_codec
+        self.frame_codec = init_params.get('frame_codec', DEFAULT_CODEC)
+        self.frame_quality = int(init_params.get('frame_quality', DEFAULT_QUALITY))
+        self.frame_seq = 0
+        # Ring frames overwritten by the decoder before processing
+        self.dropped_frames = 0
         print('min_score_thresh: ', self.min_score_thresh)
+        self.engine = None
         self.before_run_setup()
 
     def before_run_setup(self):
-        self.detection_graph = tf.Graph()
-        with self.detection_graph.as_default():
-            od_graph_def = tf.GraphDef()
-            with tf.gfile.GFile(PATH_TO_CKPT, 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
-
-            self.sess = tf.Session(graph=self.detection_graph)
-
+        # The engine and its model are acquired on the first frame
         self.fps = FPS().start()
         
         pass
 
-    async def process(self, frame):
-        self.height, self.width = frame.shape[0], frame.shape[1]
-        await self.put_output_payload(output_name='rtmp_video_size', 
-                                      payload={'height': self.height, 'width': self.width})
+    def _get_engine(self):
+        """The shared inference engine, None once the wireload is stopped:
+        an engine acquired after stop() would never be released.
+        """
+        if self.is_stop:
+            return None
+        if self.engine is None:
+            self.engine = InferenceEngine.acquire(self.edge, PATH_TO_CKPT,
+                                                  self.session_config,
+                                                  self.batch_size, self.batch_timeout_ms)
+        return self.engine
+
+    def stop(self):
+        super(ObjectDetectionWireLoad, self).stop()
+        if self.engine is not None:
+            self.engine = None
+            InferenceEngine.release(self.edge, PATH_TO_CKPT, self.session_config)
+
+    async def process(self, payload):
+        """Detect objects in a frame, output the encoded frame and the
+        detection result.
+
+        A RingFrame is read in place, without a copy: the inference engine
+        and the encoder read the ring slot. The decoder may overwrite the
+        slot meanwhile, the frame is checked after each read and dropped if
+        overwritten. A slow detection drops frames rather than copying each
+        one, give the ring enough slots for the inference latency.
+        """
+        # RingFrame of the RTMP provider frame ring, or a frame array
+        ring_frame = payload if isinstance(payload, RingFrame) else None
+        if ring_frame is not None:
+            if not ring_frame.valid():
+                self.dropped_frames += 1
+                return
+            frame = ring_frame.frame
+        else:
+            frame = payload
+        if (self.height, self.width) != frame.shape[:2]:
+            # Encoded frames carry their size, only sent for older displays
+            self.height, self.width = frame.shape[0], frame.shape[1]
+            await self.put_output_payload(output_name='rtmp_video_size', 
+                                          payload={'height': self.height, 'width': self.width})
         self.fps.update()
         # print(type(frame))
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        result = detect_objects(frame_rgb, self.sess, self.detection_graph, self.min_score_thresh)
+        engine = self._get_engine()
+        if engine is None:
+            return
+        boxes, classes, scores = await engine.detect(frame)
+        if ring_frame is not None and not ring_frame.valid():
+            # Overwritten while the engine read it
+            self.dropped_frames += 1
+            return
+        result = build_detection_result(boxes, classes, scores, self.min_score_thresh)
         # print(result)
-        await self.put_output_payload(output_name='rtmp_bytes', payload=frame.tobytes())
+        self.frame_seq = getattr(payload, 'seq', self.frame_seq + 1)
+        # JPEG encoding of a 720p frame takes milliseconds, keep it off the
+        # loop, on the worker executor in execution: process
+        frame_bytes = await self.edge.async_add_executor_job(
+            encode_frame, frame, self.frame_codec, self.frame_quality, self.frame_seq)
+        if ring_frame is not None and not ring_frame.valid():
+            self.dropped_frames += 1
+            return
+        await self.put_output_payload(output_name='rtmp_bytes', payload=frame_bytes)
         await self.put_output_payload(output_name='object_detection_result', payload=result)
-
-
-
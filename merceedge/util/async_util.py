@@ -68,6 +68,10 @@ class Context:
         type=str,
         default=attr.Factory(lambda: uuid.uuid4().hex),
     )
+    # merceedge.util.trace.Trace of a sampled message
+    trace = attr.ib(
+        default=None,
+    )
 
     def as_dict(self) -> dict:
         """Return a dictionary representation of the context."""
@@ -247,4 +251,30 @@ def run_callback_threadsafe(loop: AbstractEventLoop, callback: Callable,
                 _LOGGER.warning("Exception on lost future: ", exc_info=True)
 
     loop.call_soon_threadsafe(run_callback)
-    return future
\ No newline at end of file
+    return future
+
+def is_loop_thread(loop: AbstractEventLoop) -> bool:
+    """Return True if called from the thread running loop."""
+    ident = loop.__dict__.get("_thread_ident")
+    if ident is not None:
+        return ident == threading.get_ident()
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+def run_callback_in_loop(loop: AbstractEventLoop, callback: Callable,
+                         *args: Any) -> Any:
+    """Run callback in loop, now when called from the loop thread, else
+    scheduled with run_callback_threadsafe. Nothing runs once the loop is
+    closed.
+
+    Returns the callback result, or a concurrent.futures.Future of it when
+    scheduled.
+    """
+    if is_loop_thread(loop):
+        return callback(*args)
+    if loop.is_closed():
+        return None
+    return run_callback_threadsafe(loop, callback, *args)
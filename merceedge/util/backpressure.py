@@ -0,0 +1,90 @@
+"""
+merceedge.util.backpressure
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Bounded queues with a policy applied when the queue is full.
+
+"""
+import asyncio
+
+from merceedge.exceptions import InvalidBufferPolicy
+
+# Wait for a free slot, the producer is stalled
+POLICY_BLOCK = 'block'
+# Drop the oldest queued item to make room
+POLICY_DROP_OLDEST = 'drop_oldest'
+# Drop the item being put
+POLICY_DROP_NEWEST = 'drop_newest'
+# Keep only the newest item, a slow consumer always gets the latest one
+POLICY_LATEST_ONLY = 'latest_only'
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST,
+            POLICY_LATEST_ONLY)
+
+DEFAULT_BUFFER_SIZE = 3
+DEFAULT_BUFFER_POLICY = POLICY_BLOCK
+
+
+class WireQueue(asyncio.Queue):
+    """asyncio.Queue applying a backpressure policy when full.
+
+    Only the block policy ever waits in put(), the others drop an item and
+    count it in ``dropped``.
+    """
+    def __init__(self, maxsize=DEFAULT_BUFFER_SIZE, policy=DEFAULT_BUFFER_POLICY):
+        if policy not in POLICIES or maxsize < 1:
+            raise InvalidBufferPolicy(policy, maxsize)
+        if policy == POLICY_LATEST_ONLY:
+            maxsize = 1
+        super(WireQueue, self).__init__(maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    async def put(self, item):
+        if self.policy == POLICY_BLOCK:
+            await super(WireQueue, self).put(item)
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item):
+        if self.policy != POLICY_BLOCK and self.full():
+            self.dropped += 1
+            if self.policy == POLICY_DROP_NEWEST:
+                return
+            self.get_nowait()
+            self.task_done()
+        super(WireQueue, self).put_nowait(item)
+
+    def configure(self, maxsize, policy):
+        """Change size and policy in place, the consumers and producers
+        waiting on the queue keep waiting on it.
+
+        A dropping policy drops the oldest items beyond the new size, the
+        block policy keeps them until consumed.
+        """
+        if policy not in POLICIES or maxsize < 1:
+            raise InvalidBufferPolicy(policy, maxsize)
+        if policy == POLICY_LATEST_ONLY:
+            maxsize = 1
+        self._maxsize = maxsize
+        self.policy = policy
+        if policy != POLICY_BLOCK:
+            while self.qsize() > maxsize:
+                self.dropped += 1
+                self.get_nowait()
+                self.task_done()
+        # Wake up the producers blocked on a smaller queue
+        while self._putters and not self.full():
+            self._wakeup_next(self._putters)
+
+    def has_waiting_consumer(self):
+        """True if a consumer waits in get() for the next item."""
+        return any(not getter.done() for getter in self._getters)
+
+    def stats(self):
+        """Return queue depth, size, policy and dropped items count."""
+        return {
+            'depth': self.qsize(),
+            'size': self.maxsize,
+            'policy': self.policy,
+            'dropped': self.dropped
+        }
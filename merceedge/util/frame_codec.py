@@ -0,0 +1,122 @@
+"""
+merceedge.util.frame_codec
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Self-describing encoded video frames: a compact header with the frame
+metadata followed by the raw, JPEG or PNG encoded frame, so a frame
+travels as one message and the receiver needs no size side channel.
+
+"""
+import struct
+import time
+
+import numpy as np
+
+from merceedge.exceptions import InvalidFrame
+
+CODEC_RAW = 'raw'
+CODEC_JPEG = 'jpeg'
+CODEC_PNG = 'png'
+CODECS = (CODEC_RAW, CODEC_JPEG, CODEC_PNG)
+
+DEFAULT_CODEC = CODEC_JPEG
+# JPEG quality 0-100, PNG compression level 0-9 is quality // 10
+DEFAULT_QUALITY = 80
+
+MAGIC = b'MEFR'
+VERSION = 1
+
+# magic, version, codec, dtype, channels (0: 2D frame), height, width,
+# sequence number, timestamp
+_HEADER = struct.Struct('!4sBBBBIIQd')
+HEADER_SIZE = _HEADER.size
+
+_CODEC_IDS = {codec: index for index, codec in enumerate(CODECS)}
+_DTYPES = (np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.float32))
+_DTYPE_IDS = {dtype: index for index, dtype in enumerate(_DTYPES)}
+_IMAGE_EXTS = {CODEC_JPEG: '.jpg', CODEC_PNG: '.png'}
+
+
+class FrameHeader(object):
+    """Metadata of an encoded frame."""
+    __slots__ = ['codec', 'dtype', 'shape', 'seq', 'timestamp']
+
+    def __init__(self, codec, dtype, shape, seq, timestamp):
+        self.codec = codec
+        self.dtype = dtype
+        self.shape = shape
+        self.seq = seq
+        self.timestamp = timestamp
+
+    @property
+    def height(self):
+        return self.shape[0]
+
+    @property
+    def width(self):
+        return self.shape[1]
+
+
+def _cv2():
+    # OpenCV is only needed for the image codecs
+    import cv2
+    return cv2
+
+
+def encode_frame(frame, codec=DEFAULT_CODEC, quality=DEFAULT_QUALITY,
+                 seq=0, timestamp=None):
+    """Encode a frame array (height, width[, channels]) with its header."""
+    if codec not in _CODEC_IDS:
+        raise InvalidFrame("Unknown frame codec {}".format(codec))
+    frame = np.asarray(frame)
+    dtype_id = _DTYPE_IDS.get(frame.dtype)
+    if dtype_id is None or frame.ndim not in (2, 3):
+        raise InvalidFrame("Unsupported frame {} {}".format(frame.dtype, frame.shape))
+    channels = frame.shape[2] if frame.ndim == 3 else 0
+    if timestamp is None:
+        timestamp = time.time()
+    header = _HEADER.pack(MAGIC, VERSION, _CODEC_IDS[codec], dtype_id, channels,
+                          frame.shape[0], frame.shape[1], seq, timestamp)
+    if codec == CODEC_RAW:
+        return header + np.ascontiguousarray(frame).tobytes()
+
+    cv2 = _cv2()
+    if codec == CODEC_JPEG:
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, min(9, max(0, int(quality) // 10))]
+    ok, data = cv2.imencode(_IMAGE_EXTS[codec], frame, params)
+    if not ok:
+        raise InvalidFrame("Frame {} encoding failed".format(codec))
+    return header + data.tobytes()
+
+
+def decode_header(data):
+    """Return the FrameHeader of an encoded frame."""
+    if len(data) < HEADER_SIZE:
+        raise InvalidFrame("Frame shorter than its header")
+    magic, version, codec_id, dtype_id, channels, height, width, seq, timestamp = \
+        _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise InvalidFrame("Not an encoded frame")
+    if codec_id >= len(CODECS) or dtype_id >= len(_DTYPES):
+        raise InvalidFrame("Unknown frame codec {} dtype {}".format(codec_id, dtype_id))
+    shape = (height, width, channels) if channels else (height, width)
+    return FrameHeader(CODECS[codec_id], _DTYPES[dtype_id], shape, seq, timestamp)
+
+
+def decode_frame(data):
+    """Decode an encoded frame, return (FrameHeader, frame array)."""
+    header = decode_header(data)
+    body = memoryview(data)[HEADER_SIZE:]
+    if header.codec == CODEC_RAW:
+        expected = int(np.prod(header.shape)) * header.dtype.itemsize
+        if len(body) != expected:
+            raise InvalidFrame("Raw frame of {} bytes, expected {}".format(len(body), expected))
+        return header, np.frombuffer(body, dtype=header.dtype).reshape(header.shape)
+
+    cv2 = _cv2()
+    frame = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if frame is None:
+        raise InvalidFrame("Frame {} decoding failed".format(header.codec))
+    return header, frame
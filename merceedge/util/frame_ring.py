@@ -0,0 +1,142 @@
+"""
+merceedge.util.frame_ring
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Fixed-size ring of preallocated video frame slots in shared memory. The
+decoder writes frames in place, consumers get read-only views of a slot
+plus its sequence number, in the same process or in worker processes.
+
+"""
+import weakref
+
+import numpy as np
+
+from merceedge.util.process_worker import untrack_shared_memory
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8, the ring is only usable in process
+    shared_memory = None
+
+DEFAULT_RING_SLOTS = 8
+_SEQ_DTYPE = np.int64
+
+# Rings created or attached by this process, key: shared memory name
+_rings = weakref.WeakValueDictionary()
+_attached_rings = []
+
+
+class FrameRing(object):
+    """Ring of ``slots`` frames of ``shape``/``dtype``.
+
+    The segment starts with the sequence number of each slot, followed by the
+    frames. A slot is reused ``slots`` frames later, a consumer keeping a
+    frame across awaits or threads takes RingFrame.copy(), or reads the
+    frame in place and checks RingFrame.valid() after the read.
+    """
+    def __init__(self, shape, dtype=np.uint8, slots=DEFAULT_RING_SLOTS,
+                 name=None, create=True):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        header_bytes = slots * np.dtype(_SEQ_DTYPE).itemsize
+        size = header_bytes + slots * self.frame_bytes
+        self._owner = create
+        if shared_memory is not None:
+            self._shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+            buf = self._shm.buf
+        else:
+            self._shm = None
+            buf = bytearray(size)
+        self.name = self._shm.name if self._shm is not None else None
+        if self.name is not None:
+            _rings[self.name] = self
+        self._seqs = np.ndarray((slots, ), _SEQ_DTYPE, buffer=buf)
+        self._frames = np.ndarray((slots, ) + self.shape, self.dtype,
+                                  buffer=buf, offset=header_bytes)
+        if create:
+            self._seqs[:] = -1
+        self.seq = -1
+
+    def write_slot(self):
+        """Writable frame slot of the next sequence number, fill it and call
+        commit(). The frame previously in the slot is invalid from now on.
+        """
+        index = (self.seq + 1) % self.slots
+        self._seqs[index] = -1
+        return self._frames[index]
+
+    def commit(self):
+        """Publish the slot returned by write_slot(), return its RingFrame."""
+        self.seq += 1
+        index = self.seq % self.slots
+        self._seqs[index] = self.seq
+        return RingFrame(self, index, self.seq)
+
+    def slot_seq(self, index):
+        return int(self._seqs[index])
+
+    def view(self, index):
+        frame = self._frames[index].view()
+        frame.flags.writeable = False
+        return frame
+
+    def close(self):
+        """Unlink the segment if owned. The mapping is released with the last
+        reference to the ring, so frames in flight stay readable.
+        """
+        if self._owner and self._shm is not None:
+            self._shm.unlink()
+            self._owner = False
+
+
+class RingFrame(object):
+    """Reference to a committed frame slot, pickled by reference so a worker
+    process attaches the ring instead of receiving a frame copy.
+    """
+    __slots__ = ['ring', 'index', 'seq']
+
+    def __init__(self, ring, index, seq):
+        self.ring = ring
+        self.index = index
+        self.seq = seq
+
+    @property
+    def frame(self):
+        """Read-only view of the frame"""
+        return self.ring.view(self.index)
+
+    @property
+    def shape(self):
+        return self.ring.shape
+
+    def valid(self):
+        """False once the slot is being overwritten by a newer frame."""
+        return self.ring.slot_seq(self.index) == self.seq
+
+    def copy(self):
+        """Copy of the frame, None if the slot was overwritten before or
+        during the copy.
+        """
+        if not self.valid():
+            return None
+        frame = self.ring.view(self.index).copy()
+        return frame if self.valid() else None
+
+    def __reduce__(self):
+        ring = self.ring
+        if ring.name is None:
+            raise TypeError("FrameRing without shared memory can not be pickled")
+        return (_attach_ring_frame,
+                (ring.name, ring.shape, ring.dtype.str, ring.slots, self.index, self.seq))
+
+
+def _attach_ring_frame(name, shape, dtype, slots, index, seq):
+    ring = _rings.get(name)
+    if ring is None:
+        # Consumer process, kept attached for the next frames
+        ring = FrameRing(shape, dtype, slots, name=name, create=False)
+        untrack_shared_memory(ring._shm)  # pylint: disable=protected-access
+        _attached_rings.append(ring)
+    return RingFrame(ring, index, seq)
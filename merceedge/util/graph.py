@@ -0,0 +1,53 @@
+"""
+merceedge.util.graph
+~~~~~~~~~~~~~~~~~~~~~
+
+Helpers to partition the wire graph.
+
+"""
+
+
+def connected_components(nodes, edges):
+    """ Group nodes by connected component of an undirected graph.
+
+    nodes: iterable of hashable nodes
+    edges: iterable of (node, node) pairs
+    Returns a list of node sets, in order of first appearance.
+    """
+    parent = {node: node for node in nodes}
+
+    def find(node):
+        root = parent.setdefault(node, node)
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for node_a, node_b in edges:
+        root_a, root_b = find(node_a), find(node_b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    groups = {}
+    for node in parent:
+        groups.setdefault(find(node), set()).add(node)
+    return list(groups.values())
+
+
+def partition_nodes(nodes, edges, parts):
+    """ Place connected components on parts, largest first on the least
+    loaded part. Nodes of one connected component always share a part.
+
+    Returns dict, key: node, value: part index
+    """
+    load = [0] * parts
+    placement = {}
+    groups = sorted(connected_components(nodes, edges), key=len, reverse=True)
+    for group in groups:
+        index = load.index(min(load))
+        load[index] += len(group)
+        for node in group:
+            placement[node] = index
+    return placement
@@ -0,0 +1,149 @@
+"""
+merceedge.util.metrics
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Counters and latency histograms of the bus, wires and providers.
+
+Call sites check ``Metrics.enabled`` before recording, so a disabled
+registry costs one attribute lookup. Edge shards record into the registry
+of the edge from their own threads, updates are locked.
+
+"""
+from bisect import bisect_left
+import threading
+from time import monotonic
+
+# Histogram bucket upper bounds in seconds: 1us, 2us, 4us, ... ~8.4s
+HISTOGRAM_BOUNDS = tuple(1e-6 * 2 ** i for i in range(24))
+PERCENTILES = (50, 90, 99)
+
+
+class Counter(object):
+    """Monotonic counter."""
+    __slots__ = ['value', '_lock']
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram(object):
+    """Latency histogram with exponential buckets."""
+    __slots__ = ['buckets', 'count', 'total', 'max', '_lock']
+
+    def __init__(self):
+        # One more bucket for values above the last bound
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(HISTOGRAM_BOUNDS, seconds)
+        with self._lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, percent):
+        """Return the bucket upper bound the percentile falls in."""
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                break
+        if index == len(HISTOGRAM_BOUNDS):
+            return self.max
+        return min(HISTOGRAM_BOUNDS[index], self.max)
+
+    def as_dict(self):
+        with self._lock:
+            info = {
+                'count': self.count,
+                'sum': self.total,
+                'max': self.max
+            }
+            for percent in PERCENTILES:
+                info['p{}'.format(percent)] = self.percentile(percent)
+        return info
+
+
+class Metrics(object):
+    """Registry of counters and histograms, keyed by metric name and label
+    (eg. event type, wireload id or provider name).
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._counters = {}  # key: name, value: dict of label -> Counter
+        self._histograms = {}  # key: name, value: dict of label -> Histogram
+        # Two shards must not create the same metric twice
+        self._lock = threading.Lock()
+
+    def counter(self, name, label):
+        counter = self._counters.get(name, {}).get(label)
+        if counter is None:
+            with self._lock:
+                counters = self._counters.setdefault(name, {})
+                counter = counters.get(label)
+                if counter is None:
+                    counter = counters[label] = Counter()
+        return counter
+
+    def histogram(self, name, label):
+        histogram = self._histograms.get(name, {}).get(label)
+        if histogram is None:
+            with self._lock:
+                histograms = self._histograms.setdefault(name, {})
+                histogram = histograms.get(label)
+                if histogram is None:
+                    histogram = histograms[label] = Histogram()
+        return histogram
+
+    def get_counter(self, name, label):
+        """Return counter value, 0 when never recorded."""
+        counter = self._counters.get(name, {}).get(label)
+        return counter.value if counter is not None else 0
+
+    def get_histogram(self, name, label):
+        """Return histogram as dict, None when never recorded."""
+        histogram = self._histograms.get(name, {}).get(label)
+        return histogram.as_dict() if histogram is not None else None
+
+    def as_dict(self):
+        """Snapshot of all metrics, can be read from another thread."""
+        info = {'enabled': self.enabled}
+        for name, counters in list(self._counters.items()):
+            info[name] = {label: counter.value
+                          for label, counter in list(counters.items())}
+        for name, histograms in list(self._histograms.items()):
+            info[name] = {label: histogram.as_dict()
+                          for label, histogram in list(histograms.items())}
+        return info
+
+
+def timed_call(histogram, target, *args):
+    """Call target and observe its duration."""
+    start = monotonic()
+    try:
+        return target(*args)
+    finally:
+        histogram.observe(monotonic() - start)
+
+
+async def timed_await(histogram, target, *args):
+    """Await coroutine function target and observe its duration."""
+    start = monotonic()
+    try:
+        return await target(*args)
+    finally:
+        histogram.observe(monotonic() - start)
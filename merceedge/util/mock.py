@@ -4,7 +4,9 @@ from typing import (  # noqa: F401 pylint: disable=unused-import
     Optional, Any, Callable, List, TypeVar, Dict, Coroutine, Set,
     TYPE_CHECKING, Awaitable, Iterator)
 
-from merceedge.core import EventBus
+from merceedge.core import EventBus, JobType
+from merceedge.util.metrics import Metrics
+from merceedge.util.trace import Tracer
 
 
 def gen_test_loop(edge):
@@ -23,6 +25,8 @@ class MockEdge:
     def __init__(self, package_config):
         self.user_config = package_config
         self.loop = asyncio.get_event_loop()
+        self.metrics = Metrics()
+        self.tracer = Tracer(self.metrics)
         self.bus = EventBus(self)
 
     def wireload_emit_output_payload(self, 
@@ -54,4 +58,14 @@ class MockEdge:
         else:
             task = self.loop.run_in_executor(  # type: ignore
                 None, target, *args)
-        return task
\ No newline at end of file
+        return task
+
+    def async_add_edge_job(self, job, *args: Any) -> Optional[asyncio.Future]:
+        """Add a pre-classified job from within the event loop.
+        """
+        if job.job_type is JobType.Callback:
+            self.loop.call_soon(job.target, *args)
+            return None
+        if job.job_type is JobType.Coroutinefunction:
+            return self.loop.create_task(job.target(*args))
+        return self.loop.run_in_executor(None, job.target, *args)
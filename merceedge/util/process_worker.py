@@ -0,0 +1,247 @@
+"""
+merceedge.util.process_worker
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Run a handler in a dedicated worker process. numpy arrays in the request and
+result cross the process boundary through a reusable shared memory segment
+instead of being pickled through the pipe.
+
+"""
+import multiprocessing
+import threading
+import traceback
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8, arrays are pickled
+    shared_memory = None
+
+from merceedge.exceptions import ProcessWorkerError
+from merceedge.settings import (
+    logger_access,
+    logger_code,
+    logger_console
+)
+
+_LOGGER = logger_code
+
+# Arrays smaller than this are pickled, a memcpy does not pay off
+SHARED_ARRAY_MIN_BYTES = 64 * 1024
+# How long we wait for a worker process to exit
+WORKER_STOP_TIMEOUT = 5  # seconds
+
+
+class _SharedArrayRef(object):
+    """Placeholder of an array written in the shared memory segment."""
+    __slots__ = ['shape', 'dtype', 'offset']
+
+    def __init__(self, shape, dtype, offset):
+        self.shape = shape
+        self.dtype = dtype
+        self.offset = offset
+
+
+class SharedArrayChannel(object):
+    """One direction of array transfer between two processes.
+
+    The writer side owns a shared memory segment, grown when a message does
+    not fit and reused otherwise. Requests and results are strictly
+    alternating, so a message is always read before the next one is written.
+    """
+    def __init__(self):
+        self._write_shm = None
+        self._read_shm = None
+
+    def encode(self, payload):
+        """Write large arrays of payload into shared memory.
+
+        Returns (segment name, payload with arrays replaced by references)
+        """
+        if shared_memory is None:
+            return None, payload
+        arrays = []
+        payload = self._collect(payload, arrays)
+        if not arrays:
+            return None, payload
+        size = sum(array.nbytes for array in arrays)
+        if self._write_shm is None or self._write_shm.size < size:
+            self.close_writer()
+            self._write_shm = shared_memory.SharedMemory(create=True, size=size)
+        import numpy as np
+        offset = 0
+        for array in arrays:
+            ref = array.ref
+            ref.offset = offset
+            target = np.ndarray(ref.shape, ref.dtype,
+                                buffer=self._write_shm.buf, offset=offset)
+            target[...] = array.value
+            offset += array.nbytes
+        return self._write_shm.name, payload
+
+    def decode(self, shm_name, payload):
+        """Copy arrays referenced by payload out of the shared memory."""
+        if shm_name is None:
+            return payload
+        if self._read_shm is None or self._read_shm.name != shm_name:
+            self.close_reader()
+            self._read_shm = shared_memory.SharedMemory(name=shm_name)
+            untrack_shared_memory(self._read_shm)
+        return self._restore(payload)
+
+    def close_writer(self):
+        if self._write_shm is not None:
+            self._write_shm.close()
+            self._write_shm.unlink()
+            self._write_shm = None
+
+    def close_reader(self):
+        if self._read_shm is not None:
+            self._read_shm.close()
+            self._read_shm = None
+
+    def _collect(self, payload, arrays):
+        if isinstance(payload, dict):
+            return {key: self._collect(value, arrays) for key, value in payload.items()}
+        if isinstance(payload, (list, tuple)):
+            return type(payload)(self._collect(value, arrays) for value in payload)
+        if getattr(payload, 'nbytes', 0) >= SHARED_ARRAY_MIN_BYTES and \
+                hasattr(payload, 'dtype') and hasattr(payload, 'shape'):
+            ref = _SharedArrayRef(payload.shape, payload.dtype, 0)
+            arrays.append(_PendingArray(ref, payload))
+            return ref
+        return payload
+
+    def _restore(self, payload):
+        if isinstance(payload, dict):
+            return {key: self._restore(value) for key, value in payload.items()}
+        if isinstance(payload, (list, tuple)):
+            return type(payload)(self._restore(value) for value in payload)
+        if isinstance(payload, _SharedArrayRef):
+            import numpy as np
+            return np.ndarray(payload.shape, payload.dtype,
+                              buffer=self._read_shm.buf,
+                              offset=payload.offset).copy()
+        return payload
+
+
+class _PendingArray(object):
+    __slots__ = ['ref', 'value', 'nbytes']
+
+    def __init__(self, ref, value):
+        self.ref = ref
+        self.value = value
+        self.nbytes = value.nbytes
+
+
+def untrack_shared_memory(shm):
+    """Segment attached by a process which does not own it: the owner
+    unlinks it, the resource tracker must not.
+    """
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')  # pylint: disable=protected-access
+    except (ImportError, AttributeError, KeyError):
+        pass
+
+
+def _worker_main(conn, setup):
+    """Worker process entry: build the handler and serve requests."""
+    handler = setup()
+    requests = SharedArrayChannel()
+    results = SharedArrayChannel()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        shm_name, payload = message
+        try:
+            result = handler(requests.decode(shm_name, payload))
+            conn.send((True,) + results.encode(result))
+        except Exception:  # pylint: disable=broad-except
+            conn.send((False, None, traceback.format_exc()))
+    requests.close_reader()
+    results.close_writer()
+    conn.close()
+
+
+class ProcessWorker(object):
+    """Dedicated worker process calling ``setup()`` once, then the returned
+    handler for each request.
+
+    setup is handed to the child through fork, it does not need to be
+    picklable. Calls are serialized, call them from an executor thread. A
+    call raises ProcessWorkerError if the worker process died, the next one
+    starts a new worker process.
+
+    The child is forked from a process already running threads (executor,
+    MQTT client, decoders): only the forking thread survives in the child,
+    locks held by the others stay locked. setup and the handler must build
+    their own state (event loop, models, clients) and not use the threads
+    or the locked resources inherited from the parent.
+    """
+    def __init__(self, setup, name=None):
+        self.name = name or 'ProcessWorker'
+        self._setup = setup
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._requests = SharedArrayChannel()
+        self._results = SharedArrayChannel()
+
+    def start(self):
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            ctx = multiprocessing.get_context()
+        threads = [thread.name for thread in threading.enumerate()
+                   if thread is not threading.current_thread()]
+        if threads:
+            _LOGGER.debug("Process worker {} forked while threads run: {}".format(
+                self.name, ', '.join(threads)))
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_worker_main,
+                                    args=(child_conn, self._setup),
+                                    name=self.name,
+                                    daemon=True)
+        self._process.start()
+        child_conn.close()
+        _LOGGER.info("Started process worker {} pid {}".format(self.name, self._process.pid))
+
+    def call(self, payload):
+        """Run the handler on payload in the worker process, return result."""
+        with self._lock:
+            if self._process is None:
+                self.start()
+            try:
+                self._conn.send(self._requests.encode(payload))
+                success, shm_name, result = self._conn.recv()
+            except (EOFError, OSError) as e:
+                # The child died, the next call starts a new one
+                self._stop_process()
+                raise ProcessWorkerError(
+                    self.name, "Worker process exited: {!r}".format(e))
+            if not success:
+                raise ProcessWorkerError(self.name, result)
+            return self._results.decode(shm_name, result)
+
+    def stop(self):
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self._stop_process()
+
+    def _stop_process(self):
+        self._process.join(WORKER_STOP_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._conn.close()
+        self._requests.close_writer()
+        self._results.close_reader()
+        self._process = None
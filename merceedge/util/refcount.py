@@ -0,0 +1,63 @@
+"""
+merceedge.util.refcount
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Share expensive resources (models, client connections) by key: created on
+first acquire, closed on last release.
+
+"""
+import threading
+
+
+class RefCountedRegistry(object):
+    """Reference counted values keyed by a hashable key. Thread safe, the
+    factory of a key runs once even if acquired concurrently.
+    """
+    def __init__(self):
+        self._entries = {}  # key: [value, reference count]
+        self._lock = threading.Lock()
+
+    def acquire(self, key, factory):
+        """Return value of key, created with factory() if not shared yet."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [factory(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, key, close=None):
+        """Drop one reference of key, close(value) on the last one.
+
+        Returns True if the value was closed and removed.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry[1] -= 1
+            if entry[1] > 0:
+                return False
+            del self._entries[key]
+        if close is not None:
+            close(entry[0])
+        return True
+
+    def discard(self, key):
+        """Remove key whatever its reference count, return its value or
+        None. The caller closes the value.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def count(self, key):
+        """Number of references of key."""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,131 @@
+"""
+merceedge.util.topic
+~~~~~~~~~~~~~~~~~~~~~
+
+MQTT topic filter index: a trie of topic levels understanding the ``+``
+(one level) and ``#`` (any remaining levels) wildcards, mapping a topic to
+the subscribers of every matching filter with one walk.
+
+"""
+from merceedge.exceptions import InvalidTopicFilter
+
+SEPARATOR = '/'
+SINGLE_LEVEL = '+'
+MULTI_LEVEL = '#'
+
+
+def validate_filter(topic_filter):
+    """Raise InvalidTopicFilter unless topic_filter is a valid filter."""
+    if not topic_filter:
+        raise InvalidTopicFilter(topic_filter)
+    levels = topic_filter.split(SEPARATOR)
+    for index, level in enumerate(levels):
+        if level in (SINGLE_LEVEL, MULTI_LEVEL):
+            if level == MULTI_LEVEL and index != len(levels) - 1:
+                raise InvalidTopicFilter(topic_filter)
+        elif SINGLE_LEVEL in level or MULTI_LEVEL in level:
+            raise InvalidTopicFilter(topic_filter)
+    return levels
+
+
+class _Node(object):
+    __slots__ = ['children', 'subscribers']
+
+    def __init__(self):
+        self.children = {}  # key: topic level
+        self.subscribers = {}  # key: subscriber, value: data
+
+
+class TopicTrie(object):
+    """Subscribers keyed by topic filter. Not thread safe."""
+    def __init__(self):
+        self._root = _Node()
+        self._filters = 0
+
+    def add(self, topic_filter, subscriber, data=None):
+        """Subscribe subscriber to topic_filter.
+
+        Returns True if the filter had no subscriber yet.
+        """
+        node = self._root
+        for level in validate_filter(topic_filter):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        first = not node.subscribers
+        if first:
+            self._filters += 1
+        node.subscribers[subscriber] = data
+        return first
+
+    def remove(self, topic_filter, subscriber):
+        """Unsubscribe subscriber from topic_filter.
+
+        Returns True if the filter has no subscriber left.
+        """
+        path = []
+        node = self._root
+        for level in topic_filter.split(SEPARATOR):
+            child = node.children.get(level)
+            if child is None:
+                return False
+            path.append((node, level))
+            node = child
+        if subscriber not in node.subscribers:
+            return False
+        del node.subscribers[subscriber]
+        if node.subscribers:
+            return False
+        self._filters -= 1
+        # Prune the branch of nodes left without subscribers and children
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.subscribers or child.children:
+                break
+            del parent.children[level]
+        return True
+
+    def subscribers(self, topic_filter):
+        """Subscribers of topic_filter, key: subscriber, value: data"""
+        node = self._root
+        for level in topic_filter.split(SEPARATOR):
+            node = node.children.get(level)
+            if node is None:
+                return {}
+        return dict(node.subscribers)
+
+    def match(self, topic):
+        """Return the subscribers of the filters matching topic."""
+        matched = []
+        nodes = [self._root]
+        # Wildcards at the first level do not match $SYS like topics
+        system = topic.startswith('$')
+        for depth, level in enumerate(topic.split(SEPARATOR)):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if depth or not system:
+                    child = children.get(MULTI_LEVEL)
+                    if child is not None:
+                        matched.extend(child.subscribers)
+                    child = children.get(SINGLE_LEVEL)
+                    if child is not None:
+                        next_nodes.append(child)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            if not next_nodes:
+                return matched
+            nodes = next_nodes
+        for node in nodes:
+            matched.extend(node.subscribers)
+            # 'a/#' also matches 'a'
+            child = node.children.get(MULTI_LEVEL)
+            if child is not None:
+                matched.extend(child.subscribers)
+        return matched
+
+    def __len__(self):
+        """Number of filters with subscribers"""
+        return self._filters
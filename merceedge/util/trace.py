@@ -0,0 +1,104 @@
+"""
+merceedge.util.trace
+~~~~~~~~~~~~~~~~~~~~~
+
+Sampled tracing of messages through the wires. A sampled message carries a
+Trace in its event Context, stamped at each hop, and per wire hop latencies
+are aggregated in the metrics histograms.
+
+"""
+import itertools
+from time import monotonic
+
+from merceedge.util.async_util import Context
+
+HOP_PROVIDER_RECEIVE = 'provider_receive'
+HOP_BUS_DISPATCH = 'bus_dispatch'
+HOP_OUTPUT_SINK = 'output_sink'
+HOP_INPUT_EMIT = 'input_emit'
+HOP_PROVIDER_PUBLISH = 'provider_publish'
+HOP_WIRELOAD_DEQUEUE = 'wireload_dequeue'
+HOP_PROCESS_DONE = 'process_done'
+HOPS = (HOP_PROVIDER_RECEIVE, HOP_BUS_DISPATCH, HOP_OUTPUT_SINK, HOP_INPUT_EMIT,
+        HOP_PROVIDER_PUBLISH, HOP_WIRELOAD_DEQUEUE, HOP_PROCESS_DONE)
+TRACE_TOTAL = 'total'
+
+
+def trace_metric_name(hop):
+    """Histogram name of the time spent since the previous hop."""
+    return 'trace_{}_seconds'.format(hop)
+
+
+class Trace(object):
+    """Timestamps of a message at each hop, bound to a wire once routed."""
+    __slots__ = ['hops', 'wire_id']
+
+    def __init__(self, hops=None, wire_id=None):
+        self.hops = hops if hops is not None else []
+        self.wire_id = wire_id
+
+    def stamp(self, hop):
+        self.hops.append((hop, monotonic()))
+
+    def fork(self, wire_id):
+        """Copy of the trace for one of the wires a message fans out to."""
+        return Trace(list(self.hops), wire_id)
+
+
+class TracedPayload(object):
+    """WireLoad input queue item of a sampled message."""
+    __slots__ = ['payload', 'trace']
+
+    def __init__(self, payload, trace):
+        self.payload = payload
+        self.trace = trace
+
+
+def untrace_payloads(payloads):
+    """Unwrap traced payloads of the list in place, return their traces."""
+    traces = []
+    for index, payload in enumerate(payloads):
+        if type(payload) is TracedPayload:
+            payloads[index] = payload.payload
+            traces.append(payload.trace)
+    return traces
+
+
+class Tracer(object):
+    """Sample one message in ``sample_every``, 0 disables tracing."""
+    def __init__(self, metrics, sample_every=0):
+        self.metrics = metrics
+        self.sample_every = sample_every
+        # Called from provider, decoder and loop threads, next() of an
+        # itertools.count is atomic
+        self._count = itertools.count(1)
+
+    def sample_context(self):
+        """Return a traced Context for a sampled message, else None."""
+        if next(self._count) % self.sample_every:
+            return None
+        trace = Trace()
+        trace.stamp(HOP_PROVIDER_RECEIVE)
+        return Context(trace=trace)
+
+    def finish(self, trace):
+        """Record the hop latencies of trace on its wire."""
+        if trace.wire_id is None or not trace.hops:
+            return
+        metrics = self.metrics
+        previous = trace.hops[0][1]
+        for hop, stamp in trace.hops[1:]:
+            metrics.histogram(trace_metric_name(hop), trace.wire_id).observe(
+                stamp - previous)
+            previous = stamp
+        metrics.histogram(trace_metric_name(TRACE_TOTAL), trace.wire_id).observe(
+            previous - trace.hops[0][1])
+
+    def wire_stats(self, wire_id):
+        """Return hop latency histograms of the wire."""
+        info = {}
+        for hop in HOPS[1:] + (TRACE_TOTAL, ):
+            histogram = self.metrics.get_histogram(trace_metric_name(hop), wire_id)
+            if histogram is not None:
+                info[hop] = histogram
+        return info